@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Benchmark of the filter_datum redaction paths.
+
+Usage: ./bench_filter_datum.py [-n LINES]
+"""
+
+
+import argparse
+import re
+import time
+from typing import Callable, List
+
+from filtered_logger import (
+    PII_FIELDS, RedactingFormatter, TokenizingRedactionEngine, filter_datum,
+    patterns,
+)
+
+
+def legacy_filter_datum(
+        fields: List[str], redaction: str, message: str, separator: str,
+) -> str:
+    """The original filter_datum, rebuilding the pattern on every call."""
+    extract, replace = (patterns["extract"], patterns["replace"])
+    return re.sub(extract(fields, separator), replace(redaction), message)
+
+
+def make_lines(count: int) -> List[str]:
+    """Builds `count` synthetic `name=...;email=...;` log lines."""
+    return [
+        "name=user{0};email=user{0}@example.com;phone=555-{0:04d};"
+        "ssn=123-45-{0:04d};password=pwd{0};ip=10.0.0.{1};"
+        "last_login=2019-11-14 06:14:24;user_agent=Mozilla/5.0;".format(
+            i, i % 256)
+        for i in range(count)
+    ]
+
+
+def run(func: Callable[..., str], lines: List[str]) -> float:
+    """Redacts every line with `func` and returns the elapsed seconds."""
+    redaction = RedactingFormatter.REDACTION
+    separator = RedactingFormatter.SEPARATOR
+    start = time.perf_counter()
+    for line in lines:
+        func(PII_FIELDS, redaction, line, separator)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Compares the legacy, cached and tokenizer redaction paths."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--lines", type=int, default=1000000)
+    args = parser.parse_args()
+
+    lines = make_lines(args.lines)
+    baseline = run(legacy_filter_datum, lines)
+    print("{:<10} {:8.3f}s {:10.3f}us/line".format(
+        "legacy", baseline, baseline / len(lines) * 1e6))
+    paths = (
+        ("cached", filter_datum),
+        ("tokenizer", TokenizingRedactionEngine().filter_datum),
+    )
+    for name, func in paths:
+        elapsed = run(func, lines)
+        print("{:<10} {:8.3f}s {:10.3f}us/line  x{:.2f}".format(
+            name, elapsed, elapsed / len(lines) * 1e6, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Benchmark of the logging thread latency of get_logger.
+
+Usage: ./bench_get_logger.py [-n RECORDS] [-t THREADS]
+"""
+
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import List
+
+from filtered_logger import get_logger
+
+
+MESSAGE = ("name=Bob;email=bob@dylan.com;ssn=000-123-0000;password=bobby2019;"
+           "ip=60ed:c396:2ff:244:bbd0:9208:26f2:93ea;user_agent=Mozilla/5.0;")
+
+
+def log_records(logger: logging.Logger, count: int, out: List[float]) -> None:
+    """Logs `count` records and appends each call's latency to `out`."""
+    for _ in range(count):
+        start = time.perf_counter()
+        logger.info(MESSAGE)
+        out.append(time.perf_counter() - start)
+
+
+def run(queued: bool, count: int, threads: int) -> List[float]:
+    """Logs from `threads` threads and returns the per-call latencies."""
+    logger = get_logger(queued=queued)
+    latencies: List[float] = []
+    workers = [
+        threading.Thread(target=log_records, args=(logger, count, latencies))
+        for _ in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    return latencies
+
+
+def main() -> None:
+    """Compares the synchronous and the queued loggers."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--records", type=int, default=20000)
+    parser.add_argument("-t", "--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    # The StreamHandler writes to stderr, which is discarded here
+    sys.stderr = open(os.devnull, "w")
+    for name, queued in (("sync", False), ("queued", True)):
+        latencies = sorted(run(queued, args.records, args.threads))
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print("{:<8} mean {:8.2f}us  p50 {:8.2f}us  p99 {:8.2f}us".format(
+            name, statistics.mean(latencies) * 1e6,
+            statistics.median(latencies) * 1e6, p99 * 1e6))
+
+
+if __name__ == "__main__":
+    main()
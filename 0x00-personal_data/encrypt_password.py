@@ -1,25 +1,137 @@
 #!/usr/bin/env python3
 """Module for encrypting passwords.
+
+The work factor policy mirrors the one of
+0x03-user_authentication_service/hashing.py, both projects reading the
+same BCRYPT_ROUNDS, but this project stands on its own.
 """
 
 
+import functools
 import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
 import bcrypt
 
 
+# Work factor bounds of the calibrator, the floor being bcrypt's default
+MIN_ROUNDS = 12
+MAX_ROUNDS = 31
+
+
+def calibrate_rounds(target_ms: float = 250) -> int:
+    """Benchmarks bcrypt on the current machine and returns the highest
+    work factor whose hashing time stays under the target latency.
+
+    Args:
+        target_ms (float): Target hashing latency in milliseconds.
+
+    Returns:
+        int: The work factor, at least MIN_ROUNDS.
+    """
+    target = target_ms / 1000
+    rounds = MIN_ROUNDS
+    elapsed = _time_hash(rounds)
+    # Each extra round doubles the hashing time
+    while rounds < MAX_ROUNDS and elapsed * 2 <= target:
+        rounds += 1
+        elapsed = _time_hash(rounds)
+    return rounds - 1 if elapsed > target and rounds > MIN_ROUNDS else rounds
+
+
+def _time_hash(rounds: int) -> float:
+    """Returns the time taken to hash a password with the given rounds."""
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds))
+    return time.perf_counter() - start
+
+
+def bcrypt_rounds() -> int:
+    """Work factor used for new hashes, from BCRYPT_ROUNDS or MIN_ROUNDS."""
+    rounds = os.getenv("BCRYPT_ROUNDS")
+    return int(rounds) if rounds else MIN_ROUNDS
+
+
+class Saturated(Exception):
+    """Raised when the hashing pool has no room for another job.
+
+    Attributes:
+        retry_after (int): Seconds after which to try again.
+    """
+
+    def __init__(self, retry_after: int):
+        """Initializes the error with the seconds to wait."""
+        super(Saturated, self).__init__("hashing pool saturated")
+        self.retry_after = retry_after
+
+
+class HashingPool:
+    """Bounded thread pool for the bcrypt operations, which release the GIL.
+
+    At most `workers` jobs run at once and at most `max_pending` more wait
+    for a worker. A job beyond that raises Saturated instead of queueing.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        """Initializes the pool.
+
+        Args:
+            workers (int): Number of worker threads.
+            max_pending (int): Number of jobs allowed to wait for a worker.
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def run(self, func: Callable, *args: Any) -> Any:
+        """Runs a function on the pool and waits for its result.
+
+        Raises:
+            Saturated: If all workers are busy and the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            # Time to drain a full queue at the target latency of 250 ms
+            raise Saturated(max(1, math.ceil(
+                (self.workers + self.max_pending) * 0.25 / self.workers)))
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+
+@functools.lru_cache(maxsize=None)
+def get_pool() -> HashingPool:
+    """Returns the shared HashingPool, created on first use, with
+    HASHING_WORKERS threads (the CPU count by default) and
+    HASHING_MAX_PENDING waiting jobs (four per worker by default)."""
+    workers = int(os.getenv("HASHING_WORKERS", os.cpu_count() or 1))
+    return HashingPool(workers, int(os.getenv("HASHING_MAX_PENDING",
+                                              4 * workers)))
+
+
 def hash_password(password: str) -> bytes:
     """Hashes the provided password using bcrypt.
 
-    Use the bcrypt package to perform the hashing (with hashpw).
+    Use the bcrypt package to perform the hashing (with hashpw), with the
+    work factor of bcrypt_rounds(), on the shared HashingPool.
 
     Args:
         password (str): Password to be hashed.
 
     Returns:
         bytes: A salted, hashed password in byte string format.
+
+    Raises:
+        Saturated: If the hashing pool is saturated.
     """
     # Salt and hash the password using the bcrypt package
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    return get_pool().run(bcrypt.hashpw, password.encode('utf-8'),
+                          bcrypt.gensalt(bcrypt_rounds()))
 
 
 def is_valid(hashed_password: bytes, password: str) -> bool:
@@ -32,11 +144,22 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
     Returns:
         bool: True if the hashed password was formed from the given password,
         otherwise False.
+
+    Raises:
+        Saturated: If the hashing pool is saturated.
     """
     # Try to match the hashed password with the given password
+    password = password.encode('utf-8')
     try:
-        return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+        return get_pool().run(bcrypt.checkpw, password, hashed_password)
+    except Saturated:
+        raise
     # If there is an exception in the process, log the error message
     except Exception as e:
         logging.error("Error in password validation: {}".format(e))
         return False
+
+
+if __name__ == "__main__":
+    print("BCRYPT_ROUNDS={}".format(calibrate_rounds(
+        float(os.getenv("BCRYPT_TARGET_MS", "250")))))
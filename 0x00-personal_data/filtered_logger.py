@@ -3,11 +3,28 @@
 """
 
 
+import argparse
+import atexit
+import contextlib
+import copy
+import functools
+import json
 import logging
+import logging.handlers
 import os
-import mysql.connector
+import queue
 import re
-from typing import List
+import threading
+from typing import (
+    TYPE_CHECKING, Any, Callable, Dict, FrozenSet, Iterator, List, Mapping,
+    Optional, Pattern, Sequence, Tuple,
+)
+
+if TYPE_CHECKING:
+    # Imported by the database helpers on first use, so that the
+    # formatters and loggers do not pay for the driver
+    import mysql.connector
+    import mysql.connector.pooling
 
 
 patterns = {
@@ -26,20 +43,27 @@ class RedactingFormatter(logging.Formatter):
     filter_datum. Values for fields in fields should be filtered.
     DO NOT extrapolate FORMAT manually. The format method should be less than
     5 lines long.
+
+    Records holding a dict, as `record.msg` or through `extra={"data": ...}`,
+    are redacted field by field before anything is rendered, without
+    scanning the formatted line.
     """
 
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], tokenize: bool = False):
         """Initializes the class.
 
         Args:
             fields (List[str]): The fields.
+            tokenize (bool): Whether to redact with the single-pass
+            tokenizer instead of the regex engine.
         """
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.engine = _token_engine if tokenize else _engine
 
     def format(self, record: logging.LogRecord) -> str:
         """Filters values in incoming log records using filter_datum.
@@ -51,11 +75,309 @@ class RedactingFormatter(logging.Formatter):
             str: A string with all occurrences of the `self.fields` in
             `record.message` replaced by the `self.REDACTION` string.
         """
-        # Call the parent class's format method to get the formatted log line
+        data = structured_data(record)
+        if data is not None:
+            return self.format_structured(record, data)
+        # Call the parent class's format method, then redact self.fields
+        return self.redact(super(RedactingFormatter, self).format(record))
+
+    def format_structured(
+            self, record: logging.LogRecord, data: Mapping[str, Any],
+    ) -> str:
+        """Formats a structured record, whose dict is redacted field by
+        field, so that only a traceback or a stack is left to scan.
+
+        Args:
+            record (logging.LogRecord): A structured logging.LogRecord.
+            data (Mapping[str, Any]): The dict held by the record.
+
+        Returns:
+            str: The redacted log line.
+        """
+        record = self.render(record, data)
         msg = super(RedactingFormatter, self).format(record)
-        # Use the filter_datum function to perform substitution of self.fields
-        text = filter_datum(self.fields, self.REDACTION, msg, self.SEPARATOR)
-        return text
+        if record.exc_info or record.stack_info:
+            return self.redact(msg)
+        return msg
+
+    def redact(self, message: str) -> str:
+        """Redacts `self.fields` in a message with the redaction engine.
+
+        Args:
+            message (str): The log line.
+
+        Returns:
+            str: The redacted log line.
+        """
+        return self.engine.filter_datum(
+            self.fields, self.REDACTION, message, self.SEPARATOR)
+
+    def render(
+            self, record: logging.LogRecord, data: Mapping[str, Any],
+    ) -> logging.LogRecord:
+        """Returns a copy of a structured record whose message is the
+        redacted dict rendered as `key=value;` pairs.
+
+        Args:
+            record (logging.LogRecord): A structured logging.LogRecord.
+            data (Mapping[str, Any]): The dict held by the record.
+
+        Returns:
+            logging.LogRecord: The record to format.
+        """
+        text = " ".join(
+            "{}={}{}".format(key, value, self.SEPARATOR)
+            for key, value in filter_dict(
+                self.fields, self.REDACTION, data, self.SEPARATOR).items())
+        if record.msg is not data and record.msg:
+            text = "{} {}".format(self.redact(record.getMessage()), text)
+        record = copy.copy(record)
+        record.msg, record.args = text, None
+        return record
+
+
+class JSONRedactingFormatter(RedactingFormatter):
+    """Redacting formatter emitting one JSON object per record.
+
+    The structured dict of a record is redacted field by field into the
+    "data" member, string messages are redacted with the redaction engine.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Formats a record as a redacted JSON object.
+
+        Args:
+            record (logging.LogRecord): A logging.LogRecord instance.
+
+        Returns:
+            str: The JSON object.
+        """
+        data = structured_data(record)
+        document = {
+            "name": record.name,
+            "level": record.levelname,
+            "time": self.formatTime(record),
+        }
+        if data is None or record.msg is not data:
+            document["message"] = self.redact(record.getMessage())
+        if data is not None:
+            document["data"] = filter_dict(
+                self.fields, self.REDACTION, data, self.SEPARATOR)
+        if record.exc_info:
+            document["exc_info"] = self.redact(
+                self.formatException(record.exc_info))
+        if record.stack_info:
+            document["stack_info"] = self.redact(
+                self.formatStack(record.stack_info))
+        return json.dumps(document, default=str)
+
+
+def structured_data(record: logging.LogRecord) -> Optional[Mapping[str, Any]]:
+    """Returns the dict held by a record, as its message or its "data"
+    extra attribute, or None for plain records.
+
+    Args:
+        record (logging.LogRecord): A logging.LogRecord instance.
+
+    Returns:
+        Optional[Mapping[str, Any]]: The structured data of the record.
+    """
+    if isinstance(record.msg, Mapping):
+        return record.msg
+    data = getattr(record, "data", None)
+    return data if isinstance(data, Mapping) else None
+
+
+def filter_dict(
+        fields: Sequence[str], redaction: str, data: Mapping[str, Any],
+        separator: str = ";",
+) -> Dict[str, Any]:
+    """Returns a copy of a dict with the values of certain keys obfuscated.
+
+    Keys are matched like filter_datum matches them in a log line, i.e. a
+    key ending with a field (e.g. "user_email") is obfuscated too, and
+    string values go through filter_datum for the `field=value` pairs they
+    embed. Nested dicts are filtered the same way.
+
+    Args:
+        fields (Sequence[str]): The keys to obfuscate.
+        redaction (str): What the value will be obfuscated by.
+        data (Mapping[str, Any]): The dict, e.g. a database row.
+        separator (str): The separator between the fields of a value.
+
+    Returns:
+        Dict[str, Any]: The obfuscated dict.
+    """
+    suffixes = tuple(fields)
+    filtered = {}
+    for key, value in data.items():
+        if str(key).endswith(suffixes):
+            value = redaction
+        elif isinstance(value, str):
+            # Without "=" no field of the value can match
+            if "=" in value:
+                value = filter_datum(suffixes, redaction, value, separator)
+        elif isinstance(value, Mapping):
+            value = filter_dict(suffixes, redaction, value, separator)
+        filtered[key] = value
+    return filtered
+
+
+class RedactionEngine:
+    """Redaction engine that compiles each (fields, separator) combination
+    once and keeps the compiled patterns in a bounded LRU cache.
+
+    `RedactingFormatter.format` runs on every log line, so rebuilding the
+    pattern from `patterns['extract']` and expanding the `patterns['replace']`
+    template on every match is avoided here.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        """Initializes the engine.
+
+        Args:
+            maxsize (int): The maximum number of compiled patterns kept.
+        """
+        self.compile = functools.lru_cache(maxsize=maxsize)(self._compile)
+        self._substitute = functools.lru_cache(maxsize=maxsize)(
+            self._substitution)
+
+    def _compile(
+            self, fields: Tuple[str, ...], separator: str,
+    ) -> Pattern[str]:
+        """Compiles the extraction pattern for the given fields.
+
+        Args:
+            fields (Tuple[str, ...]): The fields to obfuscate.
+            separator (str): The separator between the fields.
+
+        Returns:
+            Pattern[str]: The compiled extraction pattern.
+        """
+        return re.compile(patterns["extract"](fields, separator))
+
+    def _substitution(
+            self, fields: Tuple[str, ...], redaction: str, separator: str,
+    ) -> Callable[[str], str]:
+        """Builds the function substituting the fields in a message.
+
+        A plain callable replacement is much cheaper than the template from
+        `patterns['replace']`, which is only kept when the redaction holds
+        escapes that the template would expand.
+
+        Args:
+            fields (Tuple[str, ...]): The fields to obfuscate.
+            redaction (str): What the field will be obfuscated by.
+            separator (str): The separator between the fields.
+
+        Returns:
+            Callable[[str], str]: The substitution function.
+        """
+        pattern = self.compile(fields, separator)
+        if "\\" in redaction:
+            return functools.partial(
+                pattern.sub, patterns["replace"](redaction))
+        suffix = "=" + redaction
+        group = pattern.groupindex["field"]
+        return functools.partial(
+            pattern.sub, lambda match: match[group] + suffix)
+
+    def filter_datum(
+            self, fields: Sequence[str], redaction: str, message: str,
+            separator: str,
+    ) -> str:
+        """Returns the log message with certain fields obfuscated.
+
+        Args:
+            fields (Sequence[str]): The fields to obfuscate.
+            redaction (str): What the field will be obfuscated by.
+            message (str): The log line.
+            separator (str): The separator between the fields.
+
+        Returns:
+            str: the log message obfuscated.
+        """
+        return self._substitute(tuple(fields), redaction, separator)(message)
+
+
+class TokenizingRedactionEngine(RedactionEngine):
+    """Redaction engine for strict `key=value;key=value;` records.
+
+    The message is split on the separator once, each key is looked up in a
+    frozenset of the fields and the line is rebuilt with a single join. The
+    output is identical to the regex engine, which still handles the
+    configurations and tokens the tokenizer cannot decide on its own.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        """Initializes the engine.
+
+        Args:
+            maxsize (int): The maximum number of compiled plans kept.
+        """
+        super().__init__(maxsize)
+        self.plan = functools.lru_cache(maxsize=maxsize)(self._plan)
+
+    def _plan(
+            self, fields: Tuple[str, ...], separator: str,
+    ) -> Optional[Tuple[FrozenSet[str], Tuple[str, ...]]]:
+        """Returns the lookup set and key suffixes for the given fields, or
+        None when the regex engine has to be used instead.
+
+        Args:
+            fields (Tuple[str, ...]): The fields to obfuscate.
+            separator (str): The separator between the fields.
+
+        Returns:
+            Optional[Tuple[FrozenSet[str], Tuple[str, ...]]]: The plan.
+        """
+        if len(separator) != 1 or separator in "=\\":
+            return None
+        for field in fields:
+            if not field or separator in field or "=" in field or \
+                    not _REGEX_META.isdisjoint(field):
+                return None
+        return (frozenset(fields), fields) if fields else None
+
+    def filter_datum(
+            self, fields: Sequence[str], redaction: str, message: str,
+            separator: str,
+    ) -> str:
+        """Returns the log message with certain fields obfuscated.
+
+        Args:
+            fields (Sequence[str]): The fields to obfuscate.
+            redaction (str): What the field will be obfuscated by.
+            message (str): The log line.
+            separator (str): The separator between the fields.
+
+        Returns:
+            str: the log message obfuscated.
+        """
+        fields = tuple(fields)
+        plan = self.plan(fields, separator)
+        if plan is None or "\\" in redaction:
+            return super().filter_datum(fields, redaction, message, separator)
+        lookup, suffixes = plan
+        substitute = self._substitute(fields, redaction, separator)
+        tokens = message.split(separator)
+        for i, token in enumerate(tokens):
+            key, equal, value = token.partition("=")
+            if not equal:
+                continue
+            # A match can only end a key at its first "=" (e.g. " email")
+            if key in lookup or key.endswith(suffixes):
+                tokens[i] = key + "=" + redaction
+            elif "=" in value:
+                tokens[i] = substitute(token)
+        return separator.join(tokens)
+
+
+# Characters with a special meaning in the extraction pattern
+_REGEX_META = frozenset(".^$*+?{}[]\\|()")
+# Shared engines used by filter_datum and RedactingFormatter
+_engine = RedactionEngine()
+_token_engine = TokenizingRedactionEngine()
 
 
 def filter_datum(
@@ -75,11 +397,112 @@ def filter_datum(
     Returns:
         str: the log message obfuscated.
     """
-    extract, replace = (patterns["extract"], patterns["replace"])
-    return re.sub(extract(fields, separator), replace(redaction), message)
+    return _engine.filter_datum(fields, redaction, message, separator)
+
+
+class _DrainingQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose stop sentinel waits for room in a full queue."""
+
+    def enqueue_sentinel(self) -> None:
+        """Puts the stop sentinel on the queue, blocking while it is full."""
+        self.queue.put(self._sentinel)
+
+
+class OverflowQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler on a bounded queue with an overflow policy.
+
+    Records are queued as they are, so formatting and redaction run on the
+    listener's background thread rather than in the logging thread.
+
+    Overflow policies:
+    1. block: wait for room in the queue
+    2. drop_oldest: discard the oldest queued record
+    3. drop_newest: discard the incoming record
+
+    Every discarded record is counted in `dropped`, as is every record
+    emitted once the handler is closed, which no longer queues anything.
+    """
+
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, records: queue.Queue, overflow: str = "block"):
+        """Initializes the handler.
+
+        Args:
+            records (queue.Queue): The queue shared with the listener.
+            overflow (str): One of `POLICIES`.
 
+        Raises:
+            ValueError: If the overflow policy is unknown.
+        """
+        if overflow not in self.POLICIES:
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        super(OverflowQueueHandler, self).__init__(records)
+        self.overflow = overflow
+        self.dropped = 0
+        self.listener = None
+        self.closed = False
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Leaves the record untouched, the listener formats it."""
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Queues the record according to the overflow policy.
+
+        It runs with the handler's lock held, see logging.Handler.handle, so
+        it never runs concurrently with the start of close(). Once closed,
+        nothing is queued: drop_oldest never evicts the listener's stop
+        sentinel and block never waits for a stopped listener.
+
+        Args:
+            record (logging.LogRecord): A logging.LogRecord instance.
+        """
+        if self.closed:
+            self.dropped += 1
+            return
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self.dropped += 1
+                if self.overflow == "drop_newest":
+                    return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                # The listener drained the queue meanwhile, nothing dropped
+                self.dropped -= 1
+
+    def start(self, *handlers: logging.Handler) -> None:
+        """Starts a background listener dispatching to `handlers`.
 
-def get_logger() -> logging.Logger:
+        Args:
+            *handlers (logging.Handler): The handlers doing the output.
+        """
+        self.listener = _DrainingQueueListener(
+            self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        """Stops the listener once every queued record is handled."""
+        with self.lock:
+            self.closed = True
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+            atexit.unregister(self.close)
+        super(OverflowQueueHandler, self).close()
+
+
+def get_logger(
+        queued: bool = False, maxsize: int = 10000, overflow: str = "block",
+) -> logging.Logger:
     """Returns a logging.Logger object named "user_data".
 
     The logger should be named "user_data" and only log up to logging.INFO
@@ -92,6 +515,16 @@ def get_logger() -> logging.Logger:
     considered as “important” PIIs or information that you must hide in your
     logs. Use it to parameterize the formatter.
 
+    With `queued`, the StreamHandler sits behind an OverflowQueueHandler and
+    records are redacted and written on a background listener thread, which
+    is stopped at interpreter exit.
+
+    Args:
+        queued (bool): Whether to log through a queue.
+        maxsize (int): The maximum number of queued records (0 for none).
+        overflow (str): The policy of a full queue, one of
+        `OverflowQueueHandler.POLICIES`.
+
     Returns:
         logging.Logger: A logging.Logger instance.
     """
@@ -106,12 +539,17 @@ def get_logger() -> logging.Logger:
     # Create an instance of the RedactingFormatter class with the PII_FIELDS,
     # as fields and set the formatter of the handler
     stream_handler.setFormatter(RedactingFormatter(PII_FIELDS))
-    # Add the handler to the logger
-    logger.addHandler(stream_handler)
+    # Add the handler to the logger, behind a queue when asked to
+    if queued:
+        queue_handler = OverflowQueueHandler(queue.Queue(maxsize), overflow)
+        queue_handler.start(stream_handler)
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(stream_handler)
     return logger
 
 
-def get_db() -> mysql.connector.connection.MySQLConnection:
+def get_db() -> "mysql.connector.connection.MySQLConnection":
     """Returns a connector to the database
     (mysql.connector.connection.MySQLConnection object).
 
@@ -121,30 +559,134 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     (set the default as “root”), PERSONAL_DATA_DB_PASSWORD (set the default
     as an empty string) and PERSONAL_DATA_DB_HOST (set the default as
     “localhost”).
-    The database name is stored in PERSONAL_DATA_DB_NAME.
+    The database name is stored in PERSONAL_DATA_DB_NAME and the port in
+    PERSONAL_DATA_DB_PORT (set the default as 3306).
 
     Returns:
         mysql.connector.connection.MySQLConnection: Connector to the
         database.
     """
-    # Get the environment variables for the database credentials
-    db_host = os.getenv("PERSONAL_DATA_DB_HOST", "localhost")
-    #  OR db_name = os.environ.get('PERSONAL_DATA_DB_USERNAME', 'root')
-    db_name = os.getenv("PERSONAL_DATA_DB_NAME", "")
-    db_user = os.getenv("PERSONAL_DATA_DB_USERNAME", "root")
-    db_pwd = os.getenv("PERSONAL_DATA_DB_PASSWORD", "")
-    # Connect to the database using the obtained credentials
-    connection = mysql.connector.connect(
-        host=db_host,
-        port=3306,
-        user=db_user,
-        password=db_pwd,
-        database=db_name,
-    )
-    return connection
-
-
-def main() -> None:
+    import mysql.connector
+
+    # Connect to the database using the credentials from the environment
+    return mysql.connector.connect(**_db_config())
+
+
+def _db_config() -> Dict[str, Any]:
+    """Returns the connection arguments from the PERSONAL_DATA_DB_*
+    environment variables.
+
+    Returns:
+        Dict[str, Any]: The keyword arguments of mysql.connector.connect.
+    """
+    return {
+        "host": os.getenv("PERSONAL_DATA_DB_HOST", "localhost"),
+        "port": int(os.getenv("PERSONAL_DATA_DB_PORT", "3306")),
+        "user": os.getenv("PERSONAL_DATA_DB_USERNAME", "root"),
+        "password": os.getenv("PERSONAL_DATA_DB_PASSWORD", ""),
+        "database": os.getenv("PERSONAL_DATA_DB_NAME", ""),
+    }
+
+
+_pool: Optional["mysql.connector.pooling.MySQLConnectionPool"] = None
+_pool_lock = threading.Lock()
+
+
+def _forget_pool() -> None:
+    """Drops the pool inherited by a forked child, whose connections are
+    the parent's."""
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+def get_db_pool() -> "mysql.connector.pooling.MySQLConnectionPool":
+    """Returns the connection pool of the database, created on first use.
+
+    The pool is configured like get_db, its size is read from
+    PERSONAL_DATA_DB_POOL_SIZE (set the default as 5).
+
+    Returns:
+        mysql.connector.pooling.MySQLConnectionPool: The connection pool.
+    """
+    import mysql.connector.pooling
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name="personal_data",
+                pool_size=int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", "5")),
+                **_db_config(),
+            )
+    return _pool
+
+
+@contextlib.contextmanager
+def pooled_db() -> Iterator["mysql.connector.pooling.PooledMySQLConnection"]:
+    """Checks a connection out of the pool and back in when done.
+
+    The connection is pinged, and reconnected if needed, before it is
+    handed out.
+
+    Yields:
+        mysql.connector.pooling.PooledMySQLConnection: Connector to the
+        database.
+    """
+    connection = get_db_pool().get_connection()
+    try:
+        connection.ping(reconnect=True, attempts=3, delay=1)
+        yield connection
+    finally:
+        # Closing a pooled connection returns it to the pool
+        connection.close()
+
+
+def stream_users(
+        db: "mysql.connector.connection.MySQLConnection",
+        batch_size: int = 1000, columns: Optional[Sequence[str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Yields the rows of the users table one at a time.
+
+    The rows are read through an unbuffered cursor with fetchmany, so no
+    more than `batch_size` rows are held in memory at once.
+
+    Args:
+        db (mysql.connector.connection.MySQLConnection): Connector to the
+        database.
+        batch_size (int): The number of rows fetched per round trip.
+        columns (Optional[Sequence[str]]): The columns to select, all of
+        them by default.
+
+    Raises:
+        ValueError: If a column is not a plain identifier.
+
+    Yields:
+        Dict[str, Any]: A row of the users table.
+    """
+    projection = "*"
+    if columns:
+        for column in columns:
+            if not re.fullmatch(r"\w+", column):
+                raise ValueError("Invalid column name {}".format(column))
+        projection = ", ".join("`{}`".format(column) for column in columns)
+    cursor = db.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute("SELECT {} FROM users".format(projection))
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
+
+
+def main(
+        batch_size: int = 1000, columns: Optional[Sequence[str]] = None,
+) -> None:
     """Obtains a database connection using get_db and retrieve all rows in
     the users table and display each row under a filtered format.
 
@@ -156,6 +698,14 @@ def main() -> None:
     5. password
 
     Only your main function should run when the module is executed.
+
+    The rows are streamed from the database and logged as dicts, so each of
+    them is redacted exactly once, by the formatter.
+
+    Args:
+        batch_size (int): The number of rows fetched per round trip.
+        columns (Optional[Sequence[str]]): The columns to display, all of
+        them by default.
     """
     # Obtain a logger and set the logging level
     logger = get_logger()
@@ -163,18 +713,20 @@ def main() -> None:
 
     # Obtain a database connection
     db = get_db()
-    cursor = db.cursor()
-
-    # Retrieve all rows in the users table
-    cursor.execute("SELECT * FROM users")
-    rows = cursor.fetchall()
-
-    # Display each row under a filtered format
-    for row in rows:
-        message = "; ".join([f"{field}={row[field]}" for field in row.keys()])
-        logger.info(filter_datum(PII_FIELDS, RedactingFormatter.REDACTION,
-                                 message, RedactingFormatter.SEPARATOR))
+    try:
+        # Display each row of the users table under a filtered format
+        for row in stream_users(db, batch_size, columns):
+            logger.info(row)
+    finally:
+        db.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Display the users table under a filtered format.")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+                        help="number of rows fetched per round trip")
+    parser.add_argument("-c", "--columns", nargs="+", metavar="COLUMN",
+                        help="columns to display (default: all)")
+    args = parser.parse_args()
+    main(args.batch_size, args.columns)
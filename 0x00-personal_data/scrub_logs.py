@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Redacts the PII fields of a log file in parallel.
+
+Usage: ./scrub_logs.py INPUT OUTPUT [-w WORKERS] [-s CHUNK_MB]
+
+The input file is memory-mapped and split on line boundaries into chunks,
+which are redacted with the rules of filter_datum and PII_FIELDS in a
+process pool and written out in order. Every line is redacted on its own,
+so the output is identical whatever the number of workers.
+"""
+
+
+import argparse
+import collections
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, filter_datum
+
+
+def split_chunks(path: str, chunk_size: int) -> List[Tuple[int, int]]:
+    """Splits a file into chunks ending on line boundaries.
+
+    Args:
+        path (str): The file to split.
+        chunk_size (int): The approximate size of a chunk in bytes.
+
+    Returns:
+        List[Tuple[int, int]]: The (start, end) offsets of the chunks.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(path, "rb") as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        while start < size:
+            end = data.find(b"\n", min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def redact_chunk(path: str, start: int, end: int) -> bytes:
+    """Redacts every line of a chunk of a file.
+
+    Args:
+        path (str): The file to read.
+        start (int): The offset of the chunk.
+        end (int): The end offset of the chunk.
+
+    Returns:
+        bytes: The redacted chunk.
+    """
+    with open(path, "rb") as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        text = data[start:end].decode("utf-8", "surrogateescape")
+    lines = [
+        filter_datum(PII_FIELDS, RedactingFormatter.REDACTION, line,
+                     RedactingFormatter.SEPARATOR)
+        for line in text.split("\n")
+    ]
+    return "\n".join(lines).encode("utf-8", "surrogateescape")
+
+
+def scrub(src: str, workers: int, chunk_size: int) -> Iterator[bytes]:
+    """Yields the redacted chunks of a file in order.
+
+    At most two chunks per worker are in flight, so memory does not grow
+    with the size of the file.
+
+    Args:
+        src (str): The file to redact.
+        workers (int): The number of worker processes, 1 to redact in the
+        current process.
+        chunk_size (int): The approximate size of a chunk in bytes.
+
+    Yields:
+        bytes: The redacted chunks.
+    """
+    chunks = split_chunks(src, chunk_size)
+    if workers == 1:
+        for start, end in chunks:
+            yield redact_chunk(src, start, end)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: collections.deque = collections.deque()
+        for start, end in chunks:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(redact_chunk, src, start, end))
+        while pending:
+            yield pending.popleft().result()
+
+
+def main() -> None:
+    """Redacts a log file and reports the throughput on stderr."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="log file to redact")
+    parser.add_argument("output", help="file receiving the redacted log")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (default: CPU count)")
+    parser.add_argument("-s", "--chunk-size", type=int, default=16,
+                        help="chunk size in MB (default: 16)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.output, "wb") as output:
+        for chunk in scrub(args.input, args.workers,
+                           args.chunk_size * 1024 * 1024):
+            output.write(chunk)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(args.input) / (1024 * 1024)
+    print("{:.1f} MB in {:.2f}s: {:.1f} MB/s with {} worker(s)".format(
+        size, elapsed, size / elapsed if elapsed else 0.0, args.workers),
+        file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""Unit tests for filtered_logger.
+"""
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import unittest
+from unittest import mock
+
+import mysql.connector.connection
+import mysql.connector.pooling
+
+import filtered_logger
+from filtered_logger import (
+    PII_FIELDS, OverflowQueueHandler, RedactionEngine,
+    TokenizingRedactionEngine, filter_datum, filter_dict,
+)
+
+# Alphabet of the fuzzed keys, values and messages, biased towards the
+# characters the redaction rules care about
+ALPHABET = "aemnlp _-=;,|.*\\"
+FIELDS = ("name", "email", "phone", "ssn", "password", "e", "mail", "a.b",
+          "x*", "")
+SEPARATORS = (";", ",", "|", " ", "=", ";;", "\\", ".", "")
+REDACTIONS = ("***", "xxx", "", "\\g<0>", "a=b")
+
+
+class TestTokenizingRedactionEngine(unittest.TestCase):
+    """Tests that the tokenizer redacts exactly like the regex engine."""
+
+    def random_message(self, rng: random.Random, fields, separator) -> str:
+        """Builds a message of key=value pairs, junk and partial tokens."""
+        tokens = []
+        for _ in range(rng.randint(0, 8)):
+            key = rng.choice(list(fields) + ["".join(
+                rng.choices(ALPHABET, k=rng.randint(0, 6)))])
+            if rng.random() < 0.3:
+                key = rng.choice(("", " ", "user_", "x")) + key
+            value = "".join(rng.choices(ALPHABET, k=rng.randint(0, 8)))
+            tokens.append(rng.choice((
+                "{}={}".format(key, value), key, value,
+                "{}={}={}".format(key, value, key))))
+        message = separator.join(tokens)
+        if rng.random() < 0.5:
+            message += separator
+        return message
+
+    def test_fuzz_against_regex_engine(self):
+        """Random field lists, separators and messages give the same
+        output on both engines."""
+        rng = random.Random(20241018)
+        regex, tokenizer = RedactionEngine(), TokenizingRedactionEngine()
+        for _ in range(20000):
+            fields = rng.sample(FIELDS, rng.randint(0, 4))
+            separator = rng.choice(SEPARATORS)
+            redaction = rng.choice(REDACTIONS)
+            message = self.random_message(rng, fields, separator)
+            args = (fields, redaction, message, separator)
+            try:
+                expected = regex.filter_datum(*args)
+            except Exception as error:
+                with self.assertRaises(type(error), msg=repr(args)):
+                    tokenizer.filter_datum(*args)
+                continue
+            self.assertEqual(tokenizer.filter_datum(*args), expected,
+                             msg=repr(args))
+
+    def test_pii_record(self):
+        """A typical record is redacted field by field."""
+        message = "name=Bob;email=bob@dylan.com;ip=10.0.0.1;user_email=x;"
+        self.assertEqual(
+            TokenizingRedactionEngine().filter_datum(
+                ["name", "email"], "***", message, ";"),
+            "name=***;email=***;ip=10.0.0.1;user_email=***;")
+
+
+class TestFilterDict(unittest.TestCase):
+    """Tests that structured records are redacted like log lines."""
+
+    def test_same_rule_as_filter_datum(self):
+        """Suffixed keys and pairs embedded in values are redacted."""
+        data = {"user_email": "bob@dylan.com", "k": "email=x",
+                "ip": "10.0.0.1", "emailx": "kept"}
+        line = "".join("{}={};".format(key, value)
+                       for key, value in data.items())
+        filtered = filter_dict(PII_FIELDS, "***", data)
+        self.assertEqual(filtered, {"user_email": "***", "k": "email=***",
+                                    "ip": "10.0.0.1", "emailx": "kept"})
+        self.assertEqual(
+            "".join("{}={};".format(key, value)
+                    for key, value in filtered.items()),
+            filter_datum(PII_FIELDS, "***", line, ";"))
+
+
+class GatedHandler(logging.Handler):
+    """Handler whose output waits for its gate to open."""
+
+    def __init__(self):
+        """Starts with the gate closed."""
+        super(GatedHandler, self).__init__()
+        self.gate = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        """Records the message once the gate opens."""
+        self.gate.wait()
+        self.messages.append(record.getMessage())
+
+
+class TestOverflowQueueHandler(unittest.TestCase):
+    """Tests that closing a queued logger never hangs."""
+
+    TIMEOUT = 5
+
+    def run_briefly(self, target):
+        """Runs a function on a thread, which it must leave quickly."""
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(self.TIMEOUT)
+        self.assertFalse(thread.is_alive(), "{} hung".format(target))
+        return thread
+
+    def close_full_queue(self, overflow):
+        """Closes a handler whose queue is full while records are still
+        being logged, and returns the handler and its output."""
+        output = GatedHandler()
+        handler = OverflowQueueHandler(queue.Queue(2), overflow)
+        handler.start(output)
+        logger = logging.getLogger("test_overflow_" + overflow)
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        # One record held by the listener, then a full queue
+        logger.warning("before 0")
+        while not handler.queue.empty():
+            time.sleep(0.001)
+        for i in range(1, 3 if overflow == "block" else 10):
+            logger.warning("before %d", i)
+        closer = threading.Thread(target=handler.close, daemon=True)
+        closer.start()
+        if overflow != "block":
+            # Would evict the stop sentinel if it were queued
+            for i in range(10):
+                logger.warning("during %d", i)
+        output.gate.set()
+        closer.join(self.TIMEOUT)
+        self.assertFalse(closer.is_alive(), "close hung")
+        self.assertIsNone(handler.listener)
+        # Once closed, logging neither blocks nor queues
+        self.run_briefly(lambda: [logger.warning("after") for _ in range(5)])
+        self.assertTrue(handler.queue.empty())
+        self.assertNotIn("after", output.messages)
+        return handler, output
+
+    def test_close_block(self):
+        """Every record logged before close is output."""
+        handler, output = self.close_full_queue("block")
+        self.assertEqual(output.messages,
+                         ["before 0", "before 1", "before 2"])
+        self.assertEqual(handler.dropped, 5)
+
+    def test_close_drop_oldest(self):
+        """The newest records logged before close are output."""
+        handler, output = self.close_full_queue("drop_oldest")
+        self.assertIn("before 0", output.messages)
+        self.assertEqual(len(output.messages) + handler.dropped, 25)
+
+    def test_close_drop_newest(self):
+        """The oldest records logged before close are output."""
+        handler, output = self.close_full_queue("drop_newest")
+        self.assertEqual(output.messages[:3],
+                         ["before 0", "before 1", "before 2"])
+        self.assertEqual(len(output.messages) + handler.dropped, 25)
+
+
+class FakeConnection(mysql.connector.connection.MySQLConnection):
+    """Connection that never reaches a server, counting the connects."""
+
+    connects = 0
+    lock = threading.Lock()
+
+    def __init__(self, **kwargs):
+        """Counts the connect instead of opening a socket, the pool also
+        builds one without arguments to validate its configuration."""
+        super().__init__()
+        if kwargs:
+            with FakeConnection.lock:
+                FakeConnection.connects += 1
+        self.pings = 0
+
+    def is_connected(self) -> bool:
+        """The connection is always up."""
+        return True
+
+    def ping(self, reconnect=False, attempts=1, delay=0) -> None:
+        """Counts the pings of pooled_db."""
+        self.pings += 1
+
+    def reset_session(self, user_variables=None, session_variables=None):
+        """Nothing to reset."""
+
+    def disconnect(self) -> None:
+        """Nothing to close."""
+
+
+class TestPooledDB(unittest.TestCase):
+    """Tests that pooled_db reuses the connections of the pool."""
+
+    POOL_SIZE = 3
+
+    def setUp(self):
+        """Starts from a fresh pool on the fake connector."""
+        FakeConnection.connects = 0
+        filtered_logger._forget_pool()
+        patches = (
+            mock.patch.object(mysql.connector.pooling, "connect",
+                              FakeConnection),
+            mock.patch.dict(os.environ, {
+                "PERSONAL_DATA_DB_POOL_SIZE": str(self.POOL_SIZE)}),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(filtered_logger._forget_pool)
+
+    def test_sequential_cycles_reuse_connections(self):
+        """M checkouts open no more connections than the pool holds."""
+        used = set()
+        for _ in range(50):
+            with filtered_logger.pooled_db() as connection:
+                used.add(connection._cnx)
+        self.assertLessEqual(FakeConnection.connects, self.POOL_SIZE)
+        self.assertLessEqual(len(used), self.POOL_SIZE)
+        # Every checkout was pinged before being handed out
+        self.assertEqual(sum(cnx.pings for cnx in used), 50)
+
+    def test_concurrent_cycles_reuse_connections(self):
+        """Threads checking out at most POOL_SIZE connections at once
+        share the pool's connections."""
+        slots = threading.Semaphore(self.POOL_SIZE)
+        errors = []
+
+        def cycles():
+            """Runs pooled_db cycles, holding a slot of the pool."""
+            try:
+                for _ in range(20):
+                    with slots, filtered_logger.pooled_db():
+                        pass
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=cycles) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(FakeConnection.connects, self.POOL_SIZE)
+        self.assertIs(filtered_logger.get_db_pool(),
+                      filtered_logger.get_db_pool())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,121 @@
 #!/usr/bin/env python3
-"""A simple Flask app with user authentication features."""
+"""A simple Flask app with user authentication features.
 
-import logging
-from flask import Flask, abort, jsonify, redirect, request
-from auth import Auth
+Importing the module opens no database: the Auth of each process, and with
+it the engine, is created on first use, i.e. on the first request of each
+worker, again in a forked one. The tables are created by an explicit step,
+`flask --app app init-db`, or by the development server of `./app.py`.
+"""
 
-# Disable warning logging for cleaner output
-logging.disable(logging.WARNING)
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Optional
 
-AUTH = Auth()
-app = Flask(__name__)
+import click
+from flask import Blueprint, Flask, abort, jsonify, redirect, request
+from hashing import Saturated
+from metrics import instrument_app, instrument_engine, instrument_hasher
+from rate_limit import RateLimited, rate_limiter_from_env
 
+if TYPE_CHECKING:
+    from auth import Auth
 
-@app.route("/", methods=["GET"], strict_slashes=False)
+bp = Blueprint("app", __name__)
+
+_auth: Optional["Auth"] = None
+_auth_lock = threading.Lock()
+
+
+def get_auth() -> "Auth":
+    """Return the Auth of this process, created on first use.
+
+    Returns:
+        Auth: The Auth, on the DB_URL database whose tables must exist.
+    """
+    global _auth
+    if _auth is None:
+        with _auth_lock:
+            if _auth is None:
+                # Deferred, it pulls in SQLAlchemy and the models
+                from auth import Auth
+
+                instrument_engine()
+                instrument_hasher()
+                _auth = Auth(create_schema=False)
+    return _auth
+
+
+def _forget_auth() -> None:
+    """Drop the Auth inherited by a forked child, so that it creates its
+    own engine and hashing service instead of sharing the parent's."""
+    global _auth, _auth_lock
+    if _auth is not None:
+        _auth.after_fork()
+    _auth = None
+    _auth_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_auth)
+
+
+def __getattr__(name: str) -> Any:
+    """Keep AUTH as an alias of get_auth()."""
+    if name == "AUTH":
+        return get_auth()
+    raise AttributeError("module {} has no attribute {}".format(
+        __name__, name))
+
+
+# Attempts at logging in or resetting a password, checked before bcrypt
+LIMITS_BY_IP = rate_limiter_from_env("RATE_LIMIT_IP", "30/60")
+LIMITS_BY_EMAIL = rate_limiter_from_env("RATE_LIMIT_EMAIL", "10/60")
+
+
+def throttle(email: str) -> None:
+    """Count an attempt against the limits of the client IP and the email.
+
+    Args:
+        email (str): The email of the attempt.
+
+    Raises:
+        RateLimited: If the IP or the email has no attempt left.
+    """
+    if LIMITS_BY_IP is not None:
+        LIMITS_BY_IP.acquire(request.remote_addr or "")
+    if LIMITS_BY_EMAIL is not None and email:
+        LIMITS_BY_EMAIL.acquire(email.strip().lower())
+
+
+@bp.teardown_app_request
+def close_db_session(exception: BaseException = None) -> None:
+    """Release the database session of the request's thread."""
+    if _auth is not None:
+        _auth.close_db_session()
+
+
+@bp.app_errorhandler(Saturated)
+def hashing_saturated(error: Saturated) -> str:
+    """Saturated hashing service handler
+    Return:
+        JSON payload with status 503 and a Retry-After header.
+    """
+    response = jsonify({"message": "service unavailable"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
+
+@bp.app_errorhandler(RateLimited)
+def rate_limited(error: RateLimited) -> str:
+    """Rate limited attempt handler
+    Return:
+        JSON payload with status 429 and a Retry-After header.
+    """
+    response = jsonify({"message": "too many requests"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+
+@bp.route("/", methods=["GET"], strict_slashes=False)
 def index() -> str:
     """GET /
     Return:
@@ -21,7 +124,7 @@ def index() -> str:
     return jsonify({"message": "Bienvenue"})
 
 
-@app.route('/users', methods=['POST'])
+@bp.route('/users', methods=['POST'])
 def register_user():
     """
     POST /users route to register a new user.
@@ -36,14 +139,14 @@ def register_user():
     password = request.form.get('password')
     try:
         # Register the user using the Auth object
-        AUTH.register_user(email, password)
+        get_auth().register_user(email, password)
         return jsonify({"email": email, "message": "user created"})
     except ValueError:
         # If the user already exists, return the appropriate response
         return jsonify({"message": "email already registered"}), 400
 
 
-@app.route("/sessions", methods=["POST"], strict_slashes=False)
+@bp.route("/sessions", methods=["POST"], strict_slashes=False)
 def login() -> str:
     """POST /sessions
     Log in a user and create a session.
@@ -55,17 +158,18 @@ def login() -> str:
     """
     email = request.form.get("email")
     password = request.form.get("password")
+    throttle(email)
 
-    if not AUTH.valid_login(email, password):
+    if not get_auth().valid_login(email, password):
         abort(401)
 
-    session_id = AUTH.create_session(email)
+    session_id = get_auth().create_session(email)
     response = jsonify({"email": email, "message": "logged in"})
     response.set_cookie("session_id", session_id)
     return response
 
 
-@app.route("/sessions", methods=["DELETE"], strict_slashes=False)
+@bp.route("/sessions", methods=["DELETE"], strict_slashes=False)
 def logout() -> str:
     """DELETE /sessions
     Log out a user by destroying their session.
@@ -74,16 +178,16 @@ def logout() -> str:
         A redirect to the home route if successful.
     """
     session_id = request.cookies.get("session_id")
-    user = AUTH.get_user_from_session_id(session_id)
+    user = get_auth().get_principal_from_session_id(session_id)
 
     if user is None:
         abort(403)
 
-    AUTH.destroy_session(user.id)
+    get_auth().destroy_session(user.id)
     return redirect("/")
 
 
-@app.route("/profile", methods=["GET"], strict_slashes=False)
+@bp.route("/profile", methods=["GET"], strict_slashes=False)
 def profile() -> str:
     """GET /profile
     Return the user's email if authenticated.
@@ -93,7 +197,7 @@ def profile() -> str:
         - email: The user's email address.
     """
     session_id = request.cookies.get("session_id")
-    user = AUTH.get_user_from_session_id(session_id)
+    user = get_auth().get_principal_from_session_id(session_id)
 
     if user is None:
         abort(403)
@@ -101,7 +205,7 @@ def profile() -> str:
     return jsonify({"email": user.email})
 
 
-@app.route("/reset_password", methods=["POST"], strict_slashes=False)
+@bp.route("/reset_password", methods=["POST"], strict_slashes=False)
 def get_reset_password_token() -> str:
     """POST /reset_password
     Generate a reset password token.
@@ -112,15 +216,16 @@ def get_reset_password_token() -> str:
         - reset_token: The generated reset token.
     """
     email = request.form.get("email")
+    throttle(email)
     try:
-        reset_token = AUTH.get_reset_password_token(email)
+        reset_token = get_auth().get_reset_password_token(email)
     except ValueError:
         abort(403)
 
     return jsonify({"email": email, "reset_token": reset_token})
 
 
-@app.route("/reset_password", methods=["PUT"], strict_slashes=False)
+@bp.route("/reset_password", methods=["PUT"], strict_slashes=False)
 def update_password() -> str:
     """PUT /reset_password
     Update the user's password.
@@ -133,14 +238,45 @@ def update_password() -> str:
     email = request.form.get("email")
     reset_token = request.form.get("reset_token")
     new_password = request.form.get("new_password")
+    throttle(email)
 
     try:
-        AUTH.update_password(reset_token, new_password)
+        get_auth().update_password(reset_token, new_password)
     except ValueError:
         abort(403)
 
     return jsonify({"email": email, "message": "Password updated"})
 
 
+@click.command("init-db")
+@click.option("--reset", is_flag=True, help="Drop the tables first.")
+def init_db_command(reset: bool) -> None:
+    """Create the tables of DB_URL, or their missing columns and indexes."""
+    from db import DB
+
+    DB(reset=reset)
+    click.echo("Initialized the database.")
+
+
+def create_app() -> Flask:
+    """Create the app, opening no database, see get_auth.
+
+    Returns:
+        Flask: The app, with its routes, /metrics and the init-db command.
+    """
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    instrument_app(app)
+    app.cli.add_command(init_db_command)
+    return app
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
+    from db import DB
+
+    # The development server creates the tables itself
+    DB()
     app.run(host="0.0.0.0", port=5000)
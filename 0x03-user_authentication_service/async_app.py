@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""The ASGI flavour of the Flask app, on Quart, with the same routes and
+responses. Serve it with e.g. `hypercorn async_app:app`.
+"""
+
+import asyncio
+from quart import Quart, abort, jsonify, redirect, request
+from async_auth import AsyncAuth
+from hashing import Saturated
+from metrics import instrument_async_app, instrument_engine, instrument_hasher
+from rate_limit import (
+    MemoryRateLimiter, RateLimited, RateLimiter, rate_limiter_from_env,
+)
+
+instrument_engine()
+instrument_hasher()
+AUTH = AsyncAuth()
+app = Quart(__name__)
+instrument_async_app(app)
+
+# Attempts at logging in or resetting a password, see app.throttle
+LIMITS_BY_IP = rate_limiter_from_env("RATE_LIMIT_IP", "30/60")
+LIMITS_BY_EMAIL = rate_limiter_from_env("RATE_LIMIT_EMAIL", "10/60")
+
+
+async def _acquire(limiter: RateLimiter, key: str) -> None:
+    """Count an attempt of a key, a Redis round trip running on the
+    default executor so that it never blocks the event loop."""
+    if isinstance(limiter, MemoryRateLimiter):
+        limiter.acquire(key)
+    else:
+        await asyncio.get_running_loop().run_in_executor(
+            None, limiter.acquire, key)
+
+
+async def throttle(email: str) -> None:
+    """Count an attempt against the limits of the client IP and the email.
+
+    Raises:
+        RateLimited: If the IP or the email has no attempt left.
+    """
+    if LIMITS_BY_IP is not None:
+        await _acquire(LIMITS_BY_IP, request.remote_addr or "")
+    if LIMITS_BY_EMAIL is not None and email:
+        await _acquire(LIMITS_BY_EMAIL, email.strip().lower())
+
+
+@app.before_serving
+async def create_tables() -> None:
+    """Create and upgrade the tables before serving requests."""
+    await AUTH.init()
+
+
+@app.after_serving
+async def close_auth() -> None:
+    """Stop the sweeper and close the database after serving."""
+    await AUTH.close()
+
+
+@app.errorhandler(Saturated)
+async def hashing_saturated(error: Saturated) -> str:
+    """Saturated hashing service handler
+    Return:
+        JSON payload with status 503 and a Retry-After header.
+    """
+    response = jsonify({"message": "service unavailable"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
+
+@app.errorhandler(RateLimited)
+async def rate_limited(error: RateLimited) -> str:
+    """Rate limited attempt handler
+    Return:
+        JSON payload with status 429 and a Retry-After header.
+    """
+    response = jsonify({"message": "too many requests"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+
+@app.route("/", methods=["GET"], strict_slashes=False)
+async def index() -> str:
+    """GET /
+    Return:
+        JSON payload containing a welcome message.
+    """
+    return jsonify({"message": "Bienvenue"})
+
+
+@app.route('/users', methods=['POST'])
+async def register_user():
+    """POST /users
+    Register a new user, see app.register_user.
+    """
+    form = await request.form
+    email = form.get('email')
+    password = form.get('password')
+    try:
+        await AUTH.register_user(email, password)
+        return jsonify({"email": email, "message": "user created"})
+    except ValueError:
+        return jsonify({"message": "email already registered"}), 400
+
+
+@app.route("/sessions", methods=["POST"], strict_slashes=False)
+async def login() -> str:
+    """POST /sessions
+    Log in a user and create a session, see app.login.
+    """
+    form = await request.form
+    email = form.get("email")
+    password = form.get("password")
+    await throttle(email)
+
+    if not await AUTH.valid_login(email, password):
+        abort(401)
+
+    session_id = await AUTH.create_session(email)
+    response = jsonify({"email": email, "message": "logged in"})
+    response.set_cookie("session_id", session_id)
+    return response
+
+
+@app.route("/sessions", methods=["DELETE"], strict_slashes=False)
+async def logout() -> str:
+    """DELETE /sessions
+    Log out a user by destroying their session, see app.logout.
+    """
+    session_id = request.cookies.get("session_id")
+    user = await AUTH.get_principal_from_session_id(session_id)
+
+    if user is None:
+        abort(403)
+
+    await AUTH.destroy_session(user.id)
+    return redirect("/")
+
+
+@app.route("/profile", methods=["GET"], strict_slashes=False)
+async def profile() -> str:
+    """GET /profile
+    Return the user's email if authenticated, see app.profile.
+    """
+    session_id = request.cookies.get("session_id")
+    user = await AUTH.get_principal_from_session_id(session_id)
+
+    if user is None:
+        abort(403)
+
+    return jsonify({"email": user.email})
+
+
+@app.route("/reset_password", methods=["POST"], strict_slashes=False)
+async def get_reset_password_token() -> str:
+    """POST /reset_password
+    Generate a reset password token, see app.get_reset_password_token.
+    """
+    email = (await request.form).get("email")
+    await throttle(email)
+    try:
+        reset_token = await AUTH.get_reset_password_token(email)
+    except ValueError:
+        abort(403)
+
+    return jsonify({"email": email, "reset_token": reset_token})
+
+
+@app.route("/reset_password", methods=["PUT"], strict_slashes=False)
+async def update_password() -> str:
+    """PUT /reset_password
+    Update the user's password, see app.update_password.
+    """
+    form = await request.form
+    email = form.get("email")
+    reset_token = form.get("reset_token")
+    new_password = form.get("new_password")
+    await throttle(email)
+
+    try:
+        await AUTH.update_password(reset_token, new_password)
+    except ValueError:
+        abort(403)
+
+    return jsonify({"email": email, "message": "Password updated"})
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Async Auth module, the asyncio counterpart of the Auth module.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import time
+from typing import Optional
+
+from async_db import AsyncDB
+from async_session_store import (
+    AsyncSessionStore, async_session_store_from_env,
+)
+from db import Principal
+from tokens import hash_token
+from user import User
+import hashing
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import NoResultFound
+
+
+class AsyncAuth:
+    """AsyncAuth class to interact with the authentication database without
+    blocking the event loop: bcrypt runs on the hashing service's pool.
+    Sessions live in the same session stores as the ones of Auth.
+    """
+
+    def __init__(self, hasher: hashing.HashingService = None,
+                 sessions: AsyncSessionStore = None,
+                 reset_token_ttl: float = None):
+        """Initializes the AsyncAuth class with a database instance.
+
+        Args:
+            hasher (hashing.HashingService): The pool running the bcrypt
+                operations, the shared one by default.
+            sessions (AsyncSessionStore): The session backend, the one
+                selected by SESSION_STORE by default.
+            reset_token_ttl (float): Seconds a reset token stays valid,
+                RESET_TOKEN_TTL or 900 by default.
+        """
+        self._db = AsyncDB()
+        self._hasher = hasher or hashing.get_service()
+        self._sessions = sessions or async_session_store_from_env(self._db)
+        if reset_token_ttl is None:
+            reset_token_ttl = float(os.getenv("RESET_TOKEN_TTL", "900"))
+        self.reset_token_ttl = reset_token_ttl
+        self._sweeper: Optional[asyncio.Task] = None
+
+    async def init(self) -> None:
+        """Creates and upgrades the tables and starts the reset token
+        sweeper, every RESET_TOKEN_SWEEP_INTERVAL seconds (300 by default).
+        """
+        await self._db.init()
+        self._sweeper = asyncio.ensure_future(self._sweep(
+            float(os.getenv("RESET_TOKEN_SWEEP_INTERVAL", "300"))))
+
+    async def close(self) -> None:
+        """Stops the sweeper and closes the database."""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        await self._db.close()
+
+    async def _sweep(self, interval: float) -> None:
+        """Purges the expired reset tokens every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._db.purge_expired_reset_tokens()
+            except Exception:
+                logging.getLogger(__name__).exception("sweep failed")
+
+    async def _hash_password(self, password: str) -> str:
+        """
+        Hashes a password on the hashing service.
+
+        Raises:
+            hashing.Saturated: If the hashing service is saturated.
+        """
+        return await self._hasher.hash_password_async(password)
+
+    async def register_user(self, email: str, password: str) -> User:
+        """
+        Registers a new user with email and password, see
+        Auth.register_user.
+
+        Raises:
+            ValueError: If a user with the provided email already exists.
+            IntegrityError: If the user breaks another constraint.
+        """
+        hashed_password = await self._hash_password(password)
+        try:
+            return await self._db.add_user(email=email,
+                                           hashed_password=hashed_password)
+        except IntegrityError:
+            # Any other constraint failure, e.g. a NULL email, is no
+            # duplicate and is raised as it is
+            if email is None or not await self._is_registered(email):
+                raise
+            raise ValueError(f"User {email} already exists")
+
+    async def _is_registered(self, email: str) -> bool:
+        """Tells whether a user has this email."""
+        try:
+            await self._db.find_user_by(email=email)
+        except NoResultFound:
+            return False
+        return True
+
+    async def valid_login(self, email: str, password: str) -> bool:
+        """
+        Checks the credentials of a user, see Auth.valid_login.
+        """
+        try:
+            user = await self._db.find_user_by(email=email)
+        except NoResultFound:
+            return False
+        if not await self._hasher.run_async(
+                hashing.check_password, password, user.hashed_password):
+            return False
+        if hashing.needs_rehash(user.hashed_password):
+            await self._db.update_user(
+                user.id, hashed_password=await self._hash_password(password))
+        return True
+
+    async def create_session(self, email: str,
+                             ttl: Optional[float] = None) -> Optional[str]:
+        """
+        Creates a new session for the user with the given email, see
+        Auth.create_session.
+
+        Returns:
+            Optional[str]: The session ID, None if no user has this email.
+        """
+        try:
+            user = await self._db.find_user_by(email=email)
+        except NoResultFound:
+            return None
+        return await self._sessions.create(user, ttl)
+
+    async def get_user_from_session_id(self,
+                                       session_id: str) -> Optional[User]:
+        """
+        Finds the user of a session in the session store, see
+        Auth.get_user_from_session_id.
+        """
+        if session_id is None:
+            return None
+        return await self._sessions.get(session_id)
+
+    async def get_principal_from_session_id(
+            self, session_id: str) -> Optional[Principal]:
+        """
+        Finds the id and email of the user of a session, see
+        Auth.get_principal_from_session_id.
+        """
+        if session_id is None:
+            return None
+        return await self._sessions.get_principal(session_id)
+
+    async def destroy_session(self, user_id: int) -> None:
+        """
+        Destroys the sessions of a user.
+        """
+        await self._sessions.destroy(user_id)
+
+    async def get_reset_password_token(self, email: str) -> str:
+        """
+        Generates a reset token, see Auth.get_reset_password_token.
+
+        Raises:
+            ValueError: If no user has this email.
+        """
+        try:
+            user = await self._db.find_user_by(email=email)
+        except NoResultFound:
+            raise ValueError("User {} not found".format(email))
+        reset_token = secrets.token_urlsafe(32)
+        await self._db.add_reset_token(
+            user.id, hash_token(reset_token),
+            int(time.time() + self.reset_token_ttl))
+        return reset_token
+
+    async def update_password(self, reset_token: str, password: str) -> None:
+        """
+        Sets the password of the user of a reset token, see
+        Auth.update_password.
+
+        Raises:
+            ValueError: If the token is unknown, used or expired.
+        """
+        if not reset_token:
+            raise ValueError("Invalid reset token")
+        token_hash = hash_token(reset_token)
+        user_id = await self._db.find_reset_token(token_hash)
+        if user_id is None:
+            raise ValueError("Invalid reset token")
+        await self._db.redeem_reset_token(
+            token_hash, user_id,
+            hashed_password=await self._hash_password(password))
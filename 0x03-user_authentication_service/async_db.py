@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Async DB module
+"""
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import delete, event, select, update
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+
+from cache import TTLCache
+from db import (PRINCIPAL_STATEMENT, USER_COLUMNS, Principal,
+                apply_sqlite_pragmas, detached_copy,
+                enable_sqlite_foreign_keys, env_flag, find_statement,
+                upgrade_schema)
+from user import Base, ResetToken, User
+
+
+class AsyncDB:
+    """Asyncio counterpart of DB on the SQLAlchemy async engine, e.g. with
+    aiosqlite. Each operation runs in its own short-lived session.
+    """
+
+    def __init__(self, url: str = None,
+                 sqlite_performance: bool = None) -> None:
+        """Initialize a new AsyncDB instance, see init for the tables.
+
+        Args:
+            url (str): The database URL, ASYNC_DB_URL or
+                sqlite+aiosqlite:///a.db by default.
+            sqlite_performance (bool): Apply the SQLite performance profile
+                of DB, by default if DB_SQLITE_PERFORMANCE is true.
+        """
+        url = url or os.getenv("ASYNC_DB_URL", "sqlite+aiosqlite:///a.db")
+        if sqlite_performance is None:
+            sqlite_performance = env_flag("DB_SQLITE_PERFORMANCE")
+        self._engine = create_async_engine(
+            url, echo=env_flag("DB_ECHO"), pool_pre_ping=True)
+        if self._engine.dialect.name == "sqlite":
+            event.listen(self._engine.sync_engine, "connect",
+                         enable_sqlite_foreign_keys)
+            if sqlite_performance:
+                event.listen(self._engine.sync_engine, "connect",
+                             apply_sqlite_pragmas)
+        self._sessionmaker = sessionmaker(
+            self._engine, class_=AsyncSession, expire_on_commit=False)
+        # Users by session ID, invalidated by update_user
+        self._session_cache = TTLCache(
+            maxsize=int(os.getenv("SESSION_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("SESSION_CACHE_TTL", "60")),
+            negative_ttl=float(os.getenv("SESSION_CACHE_NEGATIVE_TTL", "5")),
+        )
+
+    @property
+    def sync_url(self) -> str:
+        """The URL of the database for a synchronous DB, i.e. with the
+        default driver of its backend, e.g. sqlite:///a.db."""
+        url = self._engine.url
+        return url.set(drivername=url.get_backend_name()).render_as_string(
+            hide_password=False)
+
+    async def init(self, reset: bool = False) -> None:
+        """Create and upgrade the tables.
+
+        Args:
+            reset (bool): Drop the tables first.
+        """
+        async with self._engine.begin() as connection:
+            if reset:
+                await connection.run_sync(Base.metadata.drop_all)
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.run_sync(upgrade_schema)
+
+    async def close(self) -> None:
+        """Dispose of the engine's connections."""
+        await self._engine.dispose()
+
+    async def add_user(self, email: str, hashed_password: str) -> User:
+        """Add a new user, see DB.add_user.
+
+        Raises:
+            IntegrityError: If the email is already registered.
+        """
+        new_user = User(email=email, hashed_password=hashed_password)
+        async with self._sessionmaker() as session:
+            session.add(new_user)
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                raise
+        return new_user
+
+    async def find_user_by(self, **kwargs) -> User:
+        """Find a user using arbitrary keyword arguments, see
+        DB.find_user_by.
+
+        Raises:
+            NoResultFound: If no user matches the criteria.
+            InvalidRequestError: If invalid query arguments are passed.
+        """
+        for key in kwargs:
+            if key not in USER_COLUMNS:
+                raise InvalidRequestError(
+                    "User has no attribute {}".format(key))
+        statement = find_statement(tuple(
+            (key, kwargs[key] is None) for key in sorted(kwargs)))
+        params = {key: value for key, value in kwargs.items()
+                  if value is not None}
+        async with self._sessionmaker() as session:
+            return (await session.execute(statement, params)).scalar_one()
+
+    async def find_user_by_session_id(self,
+                                      session_id: str) -> Optional[User]:
+        """Find the user of a session through the session cache, see
+        DB.find_user_by_session_id.
+        """
+        found, user = self._session_cache.get(session_id)
+        if found:
+            return user
+        generation = self._session_cache.generation()
+        try:
+            user = detached_copy(
+                await self.find_user_by(session_id=session_id))
+        except NoResultFound:
+            user = None
+        self._session_cache.set(session_id, user,
+                                tag=user.id if user is not None else None,
+                                generation=generation)
+        return user
+
+    async def get_session_principal(self,
+                                    session_id: str) -> Optional[Principal]:
+        """Read the id and email of the user of a session with a Core
+        statement, see DB.get_session_principal.
+        """
+        key = ("principal", session_id)
+        found, principal = self._session_cache.get(key)
+        if found:
+            return principal
+        generation = self._session_cache.generation()
+        async with self._engine.connect() as connection:
+            row = (await connection.execute(
+                PRINCIPAL_STATEMENT, {"session_id": session_id})).first()
+        principal = Principal(*row) if row is not None else None
+        self._session_cache.set(
+            key, principal,
+            tag=principal.id if principal is not None else None,
+            generation=generation)
+        return principal
+
+    async def update_user(self, user_id: int, **kwargs) -> None:
+        """Update a user's attributes, see DB.update_user.
+
+        Raises:
+            ValueError: If the user does not exist or an invalid attribute
+                is passed in kwargs.
+        """
+        for key in kwargs:
+            if key not in USER_COLUMNS:
+                raise ValueError("User has no attribute {}".format(key))
+        if not kwargs:
+            return
+        try:
+            async with self._sessionmaker() as session:
+                result = await session.execute(
+                    update(User).where(User.id == user_id).values(**kwargs)
+                    .execution_options(synchronize_session=False))
+                if result.rowcount == 0:
+                    raise ValueError(
+                        "User with id {} not found".format(user_id))
+                await session.commit()
+        finally:
+            # Cached copies of the user go stale, whatever changes
+            self._session_cache.delete_tag(user_id)
+            if kwargs.get("session_id") is not None:
+                self._session_cache.delete(kwargs["session_id"])
+                self._session_cache.delete(
+                    ("principal", kwargs["session_id"]))
+
+    async def add_reset_token(self, user_id: int, token_hash: str,
+                              expires_at: int) -> None:
+        """Store the reset token of a user, see DB.add_reset_token."""
+        async with self._sessionmaker() as session:
+            await session.execute(delete(ResetToken).where(
+                ResetToken.user_id == user_id))
+            session.add(ResetToken(token_hash=token_hash, user_id=user_id,
+                                   expires_at=expires_at))
+            await session.commit()
+
+    async def find_reset_token(self, token_hash: str) -> Optional[int]:
+        """Look up an unexpired reset token, see DB.find_reset_token."""
+        async with self._sessionmaker() as session:
+            return (await session.execute(
+                select(ResetToken.user_id).where(
+                    ResetToken.token_hash == token_hash,
+                    ResetToken.expires_at > int(time.time())))).scalar()
+
+    async def redeem_reset_token(self, token_hash: str, user_id: int,
+                                 **kwargs) -> None:
+        """Consume a reset token and update its user in one transaction,
+        see DB.redeem_reset_token.
+
+        Raises:
+            ValueError: If the token was used or expired in the meantime.
+        """
+        for key in kwargs:
+            if key not in USER_COLUMNS:
+                raise ValueError("User has no attribute {}".format(key))
+        try:
+            async with self._sessionmaker() as session:
+                result = await session.execute(delete(ResetToken).where(
+                    ResetToken.token_hash == token_hash,
+                    ResetToken.user_id == user_id,
+                    ResetToken.expires_at > int(time.time())))
+                if result.rowcount == 0:
+                    raise ValueError("Invalid reset token")
+                await session.execute(
+                    update(User).where(User.id == user_id).values(**kwargs)
+                    .execution_options(synchronize_session=False))
+                await session.commit()
+        finally:
+            self._session_cache.delete_tag(user_id)
+
+    async def purge_expired_reset_tokens(self, batch_size: int = 1000) -> int:
+        """Delete the expired reset tokens in batches, see
+        DB.purge_expired_reset_tokens.
+        """
+        now = int(time.time())
+        purged = 0
+        while True:
+            async with self._sessionmaker() as session:
+                batch = (await session.execute(
+                    select(ResetToken.token_hash).where(
+                        ResetToken.expires_at <= now).limit(batch_size)
+                )).scalars().all()
+                if not batch:
+                    return purged
+                await session.execute(delete(ResetToken).where(
+                    ResetToken.token_hash.in_(batch)))
+                await session.commit()
+            purged += len(batch)
+            if len(batch) < batch_size:
+                return purged
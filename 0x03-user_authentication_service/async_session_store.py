@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Async session store module
+
+The asyncio counterparts of the session backends of session_store:
+1. AsyncSQLSessionStore: the users.session_id column through AsyncDB,
+   behind its session cache
+2. ExecutorSessionStore: any SessionStore, e.g. the memory, Redis or
+   signed one, run on an executor so that it never blocks the event loop
+"""
+import abc
+import asyncio
+import functools
+import os
+import uuid
+from concurrent.futures import Executor
+from typing import Any, Callable, Optional
+
+from async_db import AsyncDB
+from db import DB, Principal
+from session_store import SessionStore, session_store_from_env
+from user import User
+
+
+class AsyncSessionStore(abc.ABC):
+    """Interface of the asyncio session backends, see SessionStore."""
+
+    @abc.abstractmethod
+    async def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """Create a session for a user, see SessionStore.create."""
+
+    async def get(self, session_id: str) -> Optional[User]:
+        """Find the user of a live session, see SessionStore.get."""
+        principal = await self.get_principal(session_id)
+        if principal is None:
+            return None
+        return User(id=principal.id, email=principal.email)
+
+    @abc.abstractmethod
+    async def get_principal(self, session_id: str) -> Optional[Principal]:
+        """Find the id and email of the user of a live session, see
+        SessionStore.get_principal."""
+
+    @abc.abstractmethod
+    async def destroy(self, user_id: int) -> None:
+        """Destroy every session of a user, see SessionStore.destroy."""
+
+
+class AsyncSQLSessionStore(AsyncSessionStore):
+    """Sessions in the users.session_id column, see SQLSessionStore."""
+
+    def __init__(self, db: AsyncDB) -> None:
+        """Initialize the store on a database."""
+        self._db = db
+
+    async def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """See SessionStore.create."""
+        session_id = str(uuid.uuid4())
+        await self._db.update_user(user.id, session_id=session_id)
+        return session_id
+
+    async def get(self, session_id: str) -> Optional[User]:
+        """See SessionStore.get."""
+        return await self._db.find_user_by_session_id(session_id)
+
+    async def get_principal(self, session_id: str) -> Optional[Principal]:
+        """See SessionStore.get_principal."""
+        return await self._db.get_session_principal(session_id)
+
+    async def destroy(self, user_id: int) -> None:
+        """See SessionStore.destroy."""
+        await self._db.update_user(user_id, session_id=None)
+
+
+class ExecutorSessionStore(AsyncSessionStore):
+    """A SessionStore run on an executor, so that the same backends, and
+    the same sessions, serve the Flask and the Quart apps.
+    """
+
+    def __init__(self, store: SessionStore, db: Optional[DB] = None,
+                 executor: Optional[Executor] = None) -> None:
+        """Initialize the adapter.
+
+        Args:
+            store (SessionStore): The session store.
+            db (Optional[DB]): The database of the store, if any, whose
+                session is released after each call like after a request.
+            executor (Optional[Executor]): The executor, the event loop's
+                default one if None.
+        """
+        self._store = store
+        self._db = db
+        self._executor = executor
+
+    def _call(self, func: Callable, *args: Any) -> Any:
+        """Run a method of the store, then release the database session of
+        the executor thread."""
+        try:
+            return func(*args)
+        finally:
+            if self._db is not None:
+                self._db.close_session()
+
+    async def _run(self, func: Callable, *args: Any) -> Any:
+        """Run a method of the store on the executor."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(self._call, func, *args))
+
+    async def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """See SessionStore.create."""
+        return await self._run(self._store.create, user, ttl)
+
+    async def get(self, session_id: str) -> Optional[User]:
+        """See SessionStore.get."""
+        return await self._run(self._store.get, session_id)
+
+    async def get_principal(self, session_id: str) -> Optional[Principal]:
+        """See SessionStore.get_principal."""
+        return await self._run(self._store.get_principal, session_id)
+
+    async def destroy(self, user_id: int) -> None:
+        """See SessionStore.destroy."""
+        await self._run(self._store.destroy, user_id)
+
+
+def async_session_store_from_env(db: AsyncDB) -> AsyncSessionStore:
+    """Create the store selected by SESSION_STORE, see
+    session_store_from_env: the SQL store runs on AsyncDB and the others
+    on an executor. The signed store reads the session versions through a
+    DB on the same database.
+
+    Args:
+        db (AsyncDB): The database of the SQL store.
+
+    Returns:
+        AsyncSessionStore: The session store.
+    """
+    backend = os.getenv("SESSION_STORE", "sql")
+    if backend == "sql":
+        return AsyncSQLSessionStore(db)
+    sync_db = None
+    if backend == "signed":
+        sync_db = DB(url=db.sync_url, create_schema=False)
+    return ExecutorSessionStore(session_store_from_env(sync_db), sync_db)
@@ -2,31 +2,72 @@
 """
 Auth module to handle user registration and authentication.
 """
-from db import DB
+import os
+import secrets
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from db import DB, Principal, ResetTokenSweeper
+from session_store import SessionStore, session_store_from_env
+from tokens import hash_token
 from user import User
-import bcrypt
+import hashing
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 
 class Auth:
     """Auth class to interact with the authentication database."""
 
-    def __init__(self):
-        """Initializes the Auth class with a database instance."""
-        self._db = DB()
+    def __init__(self, hasher: hashing.HashingService = None,
+                 sessions: SessionStore = None,
+                 reset_token_ttl: float = None, create_schema: bool = True):
+        """Initializes the Auth class with a database instance.
+
+        Args:
+            hasher (hashing.HashingService): The pool running the bcrypt
+                operations, the shared one by default.
+            sessions (SessionStore): The session backend, the one selected
+                by SESSION_STORE by default.
+            reset_token_ttl (float): Seconds a reset token stays valid,
+                RESET_TOKEN_TTL or 900 by default.
+            create_schema (bool): Create the tables, see DB.
+        """
+        self._db = DB(create_schema=create_schema)
+        self._hasher = hasher or hashing.get_service()
+        self._sessions = sessions or session_store_from_env(self._db)
+        if reset_token_ttl is None:
+            reset_token_ttl = float(os.getenv("RESET_TOKEN_TTL", "900"))
+        self.reset_token_ttl = reset_token_ttl
+        self._sweeper: Optional[ResetTokenSweeper] = None
+        self._sweeper_lock = threading.Lock()
+
+    def close_db_session(self) -> None:
+        """Releases the database session of the current thread."""
+        self._db.close_session()
+
+    def after_fork(self) -> None:
+        """Forgets the database connections inherited by a forked child."""
+        self._db.after_fork()
 
     def _hash_password(self, password: str) -> str:
         """
         Hashes a password and returns the hashed password.
 
+        The bcrypt work factor is the one of `hashing.bcrypt_rounds` and
+        the hashing runs on the hashing service.
+
         Args:
             password (str): The password to be hashed.
 
         Returns:
             str: The hashed password.
+
+        Raises:
+            hashing.Saturated: If the hashing service is saturated.
         """
-        return bcrypt.hashpw(password.encode("utf-8"),
-                             bcrypt.gensalt()).decode('utf-8')
+        return self._hasher.hash_password(password)
 
     def register_user(self, email: str, password: str) -> User:
         """
@@ -41,13 +82,203 @@ class Auth:
 
         Raises:
             ValueError: If a user with the provided email already exists.
+            IntegrityError: If the user breaks another constraint.
         """
+        # The unique index on email rejects duplicates at the database
+        hashed_password = self._hash_password(password)
         try:
-            self._db.find_user_by(email=email)
-            raise ValueError(f"User {email} already exists")
-        except NoResultFound:
-            # print(f"No user found with email: {email}, creating new user...")
-            hashed_password = self._hash_password(password)
-            # print(f"Password hashed: {hashed_password}")
             return self._db.add_user(email=email,
                                      hashed_password=hashed_password)
+        except IntegrityError:
+            # Any other constraint failure, e.g. a NULL email, is no
+            # duplicate and is raised as it is
+            if email is None or not self._db.find_existing_emails([email]):
+                raise
+            raise ValueError(f"User {email} already exists")
+
+    def register_users(self, credentials: Iterable[Tuple[str, str]],
+                       chunk_size: int = 1000) -> List[Dict[str, str]]:
+        """
+        Registers many users at once, e.g. for a migration.
+
+        Registered emails are looked up with one IN query per chunk, so no
+        password is hashed for them, the other passwords are hashed in
+        parallel and the users are bulk inserted one chunk per transaction.
+
+        Args:
+            credentials (Iterable[Tuple[str, str]]): The (email, password)
+                pairs of the users to register.
+            chunk_size (int): The number of users per transaction.
+
+        Returns:
+            List[Dict[str, str]]: The report of each user, in order, with
+            its email and a status of "created" or "duplicate".
+        """
+        credentials = list(credentials)
+        report = []
+        for start in range(0, len(credentials), chunk_size):
+            chunk = credentials[start:start + chunk_size]
+            existing = self._db.find_existing_emails(
+                email for email, _ in chunk)
+            new = {}
+            for email, password in chunk:
+                if email not in existing:
+                    new.setdefault(email, password)
+            hashed = self._hasher.hash_passwords(list(new.values()))
+            created = self._db.add_users_bulk(
+                ({"email": email, "hashed_password": hashed_password}
+                 for email, hashed_password in zip(new, hashed)),
+                chunk_size, existing=existing)
+            created = {row["email"] for row in created
+                       if row["status"] == "created"}
+            for email, _ in chunk:
+                status = "created" if email in created else "duplicate"
+                created.discard(email)
+                report.append({"email": email, "status": status})
+        return report
+
+    def valid_login(self, email: str, password: str) -> bool:
+        """
+        Checks the credentials of a user.
+
+        A hash made with an outdated work factor is transparently replaced
+        by a new one once the password is known to match.
+
+        Args:
+            email (str): The email of the user.
+            password (str): The password of the user.
+
+        Returns:
+            bool: True if the password matches the user's one.
+        """
+        try:
+            user = self._db.find_user_by(email=email)
+        except NoResultFound:
+            return False
+        if not self._hasher.check_password(password, user.hashed_password):
+            return False
+        if hashing.needs_rehash(user.hashed_password):
+            self._db.update_user(user.id,
+                                 hashed_password=self._hash_password(password))
+        return True
+
+    def create_session(self, email: str,
+                       ttl: Optional[float] = None) -> Optional[str]:
+        """
+        Creates a new session for the user with the given email.
+
+        Args:
+            email (str): The email of the user.
+            ttl (Optional[float]): Seconds the session lasts, the session
+                store's default if None.
+
+        Returns:
+            Optional[str]: The session ID, None if no user has this email.
+        """
+        try:
+            user = self._db.find_user_by(email=email)
+        except NoResultFound:
+            return None
+        return self._sessions.create(user, ttl)
+
+    def get_user_from_session_id(self, session_id: str) -> Optional[User]:
+        """
+        Finds the user of a session in the session store.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            Optional[User]: The user, None if the session ID is None,
+            unknown or expired.
+        """
+        if session_id is None:
+            return None
+        return self._sessions.get(session_id)
+
+    def get_principal_from_session_id(
+            self, session_id: str) -> Optional[Principal]:
+        """
+        Finds the id and email of the user of a session, without loading
+        the User, for the requests needing nothing more.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            Optional[Principal]: The user's id and email, None if the
+            session ID is None, unknown or expired.
+        """
+        if session_id is None:
+            return None
+        return self._sessions.get_principal(session_id)
+
+    def destroy_session(self, user_id: int) -> None:
+        """
+        Destroys the sessions of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+        """
+        self._sessions.destroy(user_id)
+
+    def get_reset_password_token(self, email: str) -> str:
+        """
+        Generates a reset token for the user with the given email.
+
+        Only the digest of the token is stored, replacing the previous
+        token of the user, and it expires after `reset_token_ttl` seconds.
+        The first token starts the sweeper purging the expired ones every
+        RESET_TOKEN_SWEEP_INTERVAL seconds (300 by default).
+
+        Args:
+            email (str): The email of the user.
+
+        Returns:
+            str: The reset token.
+
+        Raises:
+            ValueError: If no user has this email.
+        """
+        try:
+            user = self._db.find_user_by(email=email)
+        except NoResultFound:
+            raise ValueError("User {} not found".format(email))
+        reset_token = secrets.token_urlsafe(32)
+        self._db.add_reset_token(
+            user.id, hash_token(reset_token),
+            int(time.time() + self.reset_token_ttl))
+        self._start_sweeper()
+        return reset_token
+
+    def update_password(self, reset_token: str, password: str) -> None:
+        """
+        Sets the password of the user of a reset token, consuming the
+        token in the same transaction.
+
+        Args:
+            reset_token (str): The reset token.
+            password (str): The new password.
+
+        Raises:
+            ValueError: If the token is unknown, used or expired.
+        """
+        if not reset_token:
+            raise ValueError("Invalid reset token")
+        token_hash = hash_token(reset_token)
+        user_id = self._db.find_reset_token(token_hash)
+        if user_id is None:
+            raise ValueError("Invalid reset token")
+        self._db.redeem_reset_token(
+            token_hash, user_id,
+            hashed_password=self._hash_password(password))
+
+    def _start_sweeper(self) -> None:
+        """Starts the reset token sweeper if it is not running."""
+        if self._sweeper is not None:
+            return
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = ResetTokenSweeper(self._db, float(
+                    os.getenv("RESET_TOKEN_SWEEP_INTERVAL", "300")))
+                self._sweeper.start()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Benchmark of DB.find_user_by lookup latency against the users table size,
+with and without the lookup indexes, on temporary SQLite databases.
+
+Usage: ./bench_find_user_by.py [-s SIZE ...] [-n LOOKUPS]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from db import DB  # noqa: E402
+from user import User  # noqa: E402
+
+
+def populate(db: DB, size: int) -> None:
+    """Inserts `size` users with an email and a session ID each."""
+    rows = [{"email": "user{}@example.com".format(i),
+             "hashed_password": "hashed",
+             "session_id": "session-{}".format(i)} for i in range(size)]
+    with db._engine.begin() as connection:
+        connection.execute(User.__table__.insert(), rows)
+
+
+def time_lookups(db: DB, size: int, lookups: int) -> float:
+    """Returns the mean latency in microseconds of email and session ID
+    lookups of random users."""
+    keys = [random.randrange(size) for _ in range(lookups)]
+    start = time.perf_counter()
+    for i, key in enumerate(keys):
+        if i % 2:
+            db.find_user_by(email="user{}@example.com".format(key))
+        else:
+            db.find_user_by(session_id="session-{}".format(key))
+        # Keep the identity map from serving the lookups
+        db._session.expunge_all()
+    return (time.perf_counter() - start) / lookups * 1e6
+
+
+def main() -> None:
+    """Times the lookups at each table size, indexed and not."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-s", "--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("-n", "--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    print("{:>9} {:>14} {:>14}".format("users", "indexed", "full scan"))
+    for size in args.sizes:
+        # DB() creates a.db in the working directory
+        os.chdir(tempfile.mkdtemp())
+        db = DB()
+        populate(db, size)
+        indexed = time_lookups(db, size, args.lookups)
+        for index in User.__table__.indexes:
+            index.drop(db._engine)
+        scan = time_lookups(db, size, args.lookups)
+        print("{:>9} {:>12.1f}us {:>12.1f}us".format(size, indexed, scan))
+        db.close_session()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per-call overhead of DB.find_user_by, against the query
+it used to build on each call, on an in-memory SQLite database.
+
+Usage: ./bench_find_user_by_overhead.py [-n CALLS] [-u USERS]
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy.exc import InvalidRequestError  # noqa: E402
+
+from db import DB  # noqa: E402
+from user import User  # noqa: E402
+
+
+def legacy_find_user_by(db: DB, **kwargs) -> User:
+    """The former find_user_by: a new query built on each call."""
+    return db._session.query(User).filter_by(**kwargs).one()
+
+
+def time_calls(db: DB, find: Callable, users: int, calls: int) -> float:
+    """Returns the mean latency in microseconds of email lookups."""
+    start = time.perf_counter()
+    for i in range(calls):
+        find(db, email="user{}@example.com".format(i % users))
+        # Keep the identity map from serving the lookups
+        db._session.expunge_all()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def time_rejections(db: DB, find: Callable, calls: int) -> float:
+    """Returns the mean latency in microseconds of rejecting a lookup on
+    an unknown column."""
+    start = time.perf_counter()
+    for _ in range(calls):
+        try:
+            find(db, no_such_column="value")
+        except InvalidRequestError:
+            pass
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main() -> None:
+    """Times both lookups, after a warm-up."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--calls", type=int, default=20000)
+    parser.add_argument("-u", "--users", type=int, default=100)
+    args = parser.parse_args()
+
+    db = DB(url="sqlite://")
+    with db._engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"email": "user{}@example.com".format(i),
+             "hashed_password": "hashed"} for i in range(args.users)])
+    finds = {"query per call": legacy_find_user_by,
+             "cached statement": DB.find_user_by}
+    for find in finds.values():
+        time_calls(db, find, args.users, 1000)
+
+    print("{:>18} {:>12} {:>12}".format("", "lookup", "bad column"))
+    for name, find in finds.items():
+        print("{:>18} {:>10.1f}us {:>10.1f}us".format(
+            name, time_calls(db, find, args.users, args.calls),
+            time_rejections(db, find, args.calls)))
+
+
+if __name__ == "__main__":
+    main()
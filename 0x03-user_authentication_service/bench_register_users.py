@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Benchmark of Auth.register_users against a loop of Auth.register_user,
+on a temporary SQLite database.
+
+Usage: ./bench_register_users.py [-n USERS]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Cheap hashes keep the comparison about the database round trips
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from auth import Auth  # noqa: E402
+from db import DB  # noqa: E402
+
+
+def main() -> None:
+    """Registers the same users one by one and in bulk."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--users", type=int, default=2000)
+    args = parser.parse_args()
+
+    # DB() creates a.db in the working directory
+    os.chdir(tempfile.mkdtemp())
+    credentials = [("user{}@example.com".format(i), "pwd{}".format(i))
+                   for i in range(args.users)]
+
+    auth = Auth()
+    start = time.perf_counter()
+    for email, password in credentials:
+        auth.register_user(email, password)
+    loop = time.perf_counter() - start
+    print("register_user loop  {:8.3f}s".format(loop))
+
+    auth._db = DB(reset=True)
+    start = time.perf_counter()
+    report = auth.register_users(credentials + credentials[:10])
+    bulk = time.perf_counter() - start
+    duplicates = sum(row["status"] == "duplicate" for row in report)
+    print("register_users      {:8.3f}s  x{:.2f}  ({} duplicates)".format(
+        bulk, loop / bulk, duplicates))
+
+
+if __name__ == "__main__":
+    main()
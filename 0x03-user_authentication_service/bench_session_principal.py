@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per-request cost of reading the user of a session, as a
+full User through the ORM or as a Principal through a Core statement, on
+an in-memory SQLite database with the session cache off.
+
+Usage: ./bench_session_principal.py [-n CALLS] [-u USERS]
+
+The latency is timed without tracing. The memory is the mean peak that
+tracemalloc sees allocated during a call.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from db import DB  # noqa: E402
+from user import User  # noqa: E402
+
+
+def orm_user(db: DB, session_id: str) -> Any:
+    """Loads the full User of a session, then leaves the identity map."""
+    user = db.find_user_by(session_id=session_id)
+    db._session.expunge_all()
+    return user.email
+
+
+def principal(db: DB, session_id: str) -> Any:
+    """Reads the id and email of the user of a session."""
+    return db.get_session_principal(session_id).email
+
+
+def time_calls(db: DB, read: Callable, users: int, calls: int) -> float:
+    """Returns the mean latency in microseconds of a read."""
+    start = time.perf_counter()
+    for i in range(calls):
+        read(db, "session-{}".format(i % users))
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def trace_calls(db: DB, read: Callable, users: int, calls: int) -> float:
+    """Returns the mean peak of memory in bytes allocated by a read."""
+    total = 0
+    tracemalloc.start()
+    for i in range(calls):
+        session_id = "session-{}".format(i % users)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        read(db, session_id)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / calls
+
+
+def main() -> None:
+    """Times and traces both reads, after a warm-up."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--calls", type=int, default=20000)
+    parser.add_argument("-u", "--users", type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ["SESSION_CACHE_TTL"] = "0"
+    os.environ["SESSION_CACHE_NEGATIVE_TTL"] = "0"
+    db = DB(url="sqlite://")
+    with db._engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"email": "user{}@example.com".format(i),
+             "hashed_password": "hashed",
+             "session_id": "session-{}".format(i)}
+            for i in range(args.users)])
+    reads = {"ORM User": orm_user, "Principal": principal}
+    for read in reads.values():
+        time_calls(db, read, args.users, 1000)
+
+    print("{:>10} {:>12} {:>12}".format("", "latency", "peak alloc"))
+    for name, read in reads.items():
+        print("{:>10} {:>10.1f}us {:>11.0f}B".format(
+            name, time_calls(db, read, args.users, args.calls),
+            trace_calls(db, read, args.users, args.calls // 10)))
+    assert not db._session.identity_map, "Principal reads loaded Users"
+
+
+if __name__ == "__main__":
+    main()
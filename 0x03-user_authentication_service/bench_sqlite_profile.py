@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark of mixed read/write throughput of DB on SQLite from several
+threads, with and without the SQLite performance profile.
+
+Usage: ./bench_sqlite_profile.py [-t THREADS] [-d SECONDS] [-w WRITES]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from db import DB  # noqa: E402
+from user import User  # noqa: E402
+
+USERS = 10000
+
+
+def worker(db: DB, deadline: float, write_ratio: float,
+           counts: dict, lock: threading.Lock) -> None:
+    """Runs random lookups and session updates until the deadline."""
+    reads = writes = errors = 0
+    while time.monotonic() < deadline:
+        user_id = random.randint(1, USERS)
+        try:
+            if random.random() < write_ratio:
+                db.update_user(user_id, session_id=str(uuid.uuid4()))
+                writes += 1
+            else:
+                db.find_user_by(email="user{}@example.com".format(user_id))
+                reads += 1
+        except Exception:
+            db._session.rollback()
+            errors += 1
+    db.close_session()
+    with lock:
+        counts["reads"] += reads
+        counts["writes"] += writes
+        counts["errors"] += errors
+
+
+def run(performance: bool, threads: int, duration: float,
+        write_ratio: float) -> dict:
+    """Runs the workload on a fresh database and returns the counts."""
+    url = "sqlite:///{}".format(
+        os.path.join(tempfile.mkdtemp(), "bench.db"))
+    db = DB(url=url, sqlite_performance=performance)
+    with db._engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"email": "user{}@example.com".format(i),
+             "hashed_password": "hashed"} for i in range(1, USERS + 1)])
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    workers = [threading.Thread(target=worker,
+                                args=(db, deadline, write_ratio,
+                                      counts, lock))
+               for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return counts
+
+
+def main() -> None:
+    """Compares the default and the performance profiles."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-t", "--threads", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=5)
+    parser.add_argument("-w", "--writes", type=float, default=0.2,
+                        help="share of writes (default: 0.2)")
+    args = parser.parse_args()
+
+    for name, performance in (("default", False), ("performance", True)):
+        counts = run(performance, args.threads, args.duration, args.writes)
+        print("{:<12} {:>9.0f} ops/s  ({} reads, {} writes, {} errors)"
+              .format(name, (counts["reads"] + counts["writes"])
+                      / args.duration, counts["reads"], counts["writes"],
+                      counts["errors"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the startup of the app and of filtered_logger: import time
+measured with `python -X importtime` and cold start of a server process.
+
+Usage: ./bench_startup.py [-r RUNS] [--app-dir DIR] [--logger-dir DIR]
+
+The cold start is the time from spawning the server process to its first
+response, then to the first response needing the database, on a fresh
+SQLite database whose tables were created beforehand. Point --app-dir and
+--logger-dir at another checkout to compare versions. Medians of `--runs`
+runs are reported.
+"""
+import argparse
+import http.client
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SERVER = """
+import sys
+from werkzeug.serving import make_server
+from app import app
+make_server("127.0.0.1", int(sys.argv[1]), app, threaded=True).serve_forever()
+"""
+
+
+def import_time(directory: str, module: str) -> Tuple[float, List[str]]:
+    """Import a module in a fresh interpreter with -X importtime.
+
+    Args:
+        directory (str): The directory of the module.
+        module (str): The module name.
+
+    Returns:
+        Tuple[float, List[str]]: The cumulative import time of the module
+        in milliseconds, and its five slowest imports.
+    """
+    cwd = tempfile.mkdtemp(prefix="bench-startup-")
+    try:
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c",
+             "import {}".format(module)],
+            cwd=cwd, env=dict(os.environ, PYTHONPATH=directory),
+            capture_output=True, text=True, check=True).stderr
+    finally:
+        shutil.rmtree(cwd, ignore_errors=True)
+    # Lines of "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in stderr.splitlines():
+        parts = line.replace("import time:", "", 1).split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]), parts[2].strip()))
+    total = next(us for us, name in reversed(imports) if name == module)
+    slowest = ["{} {:.1f}ms".format(name, us / 1000)
+               for us, name in sorted(imports, reverse=True)
+               if name != module][:5]
+    return total / 1000, slowest
+
+
+def request(port: int, method: str, path: str, body: str = None) -> int:
+    """Send a request to the app and return its status."""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    try:
+        connection.request(method, path, body, headers)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def cold_start(directory: str) -> Dict[str, float]:
+    """Start a server of the app and time its first responses.
+
+    Returns:
+        Dict[str, float]: The milliseconds from the spawn to the first
+        response and to the first database response.
+    """
+    cwd = tempfile.mkdtemp(prefix="bench-startup-")
+    env = dict(os.environ, PYTHONPATH=directory, BCRYPT_ROUNDS="4",
+               RATE_LIMIT_IP="off", RATE_LIMIT_EMAIL="off")
+    subprocess.run([sys.executable, "-c", "from db import DB; DB()"],
+                   cwd=cwd, env=env, check=True)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-c", SERVER, str(port)],
+                              cwd=cwd, env=env)
+    try:
+        while True:
+            try:
+                request(port, "GET", "/")
+                break
+            except OSError:
+                if time.perf_counter() - start > 30:
+                    raise RuntimeError("the app did not start")
+                time.sleep(0.005)
+        first = time.perf_counter() - start
+        request(port, "POST", "/sessions", "email=cold%40start&password=x")
+        database = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(cwd, ignore_errors=True)
+    return {"first_response": first * 1000,
+            "first_db_response": database * 1000}
+
+
+def main() -> None:
+    """Measures and prints the medians of the runs."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-r", "--runs", type=int, default=5)
+    parser.add_argument("--app-dir", default=HERE)
+    parser.add_argument("--logger-dir", default=os.path.join(
+        HERE, "..", "0x00-personal_data"))
+    args = parser.parse_args()
+
+    for directory, module in ((args.app_dir, "app"),
+                              (args.logger_dir, "filtered_logger")):
+        runs = [import_time(directory, module) for _ in range(args.runs)]
+        print("import {:<16} {:>8.1f}ms  slowest: {}".format(
+            module, statistics.median(total for total, _ in runs),
+            ", ".join(runs[-1][1])))
+    runs = [cold_start(args.app_dir) for _ in range(args.runs)]
+    for key in ("first_response", "first_db_response"):
+        print("cold start {:<18} {:>8.1f}ms".format(
+            key, statistics.median(run[key] for run in runs)))
+
+
+if __name__ == "__main__":
+    main()
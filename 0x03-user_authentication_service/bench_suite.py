@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite of the auth service: load tests of the Flask app on a
+temporary SQLite database and micro-benchmarks, saved as JSON.
+
+Usage: ./bench_suite.py [load|micro|all] [-p PROFILE ...] [-n REQUESTS]
+                        [-c CONCURRENCY] [-o RESULTS] [--compare BASELINE]
+
+Each load profile starts the app in a fresh server process, registers and
+logs in `--users` users, then runs a seeded mix of operations from
+`--concurrency` client threads:
+- signup: mostly POST /users
+- login: mostly POST /sessions
+- profile: mostly GET /profile
+- reset: mostly POST then PUT /reset_password
+The micro-benchmarks time filter_datum (../0x00-personal_data),
+hash_password and find_user_by at several table sizes.
+
+Latencies are reported as p50/p95/p99 in milliseconds. --compare flags
+the results more than --threshold percent worse than a previous run and
+exits with status 1 if there are any.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(1, os.path.join(HERE, "..", "0x00-personal_data"))
+
+# Operation weights of the load profiles
+PROFILES = {
+    "signup": {"signup": 70, "login": 20, "profile": 10},
+    "login": {"login": 70, "profile": 20, "signup": 10},
+    "profile": {"profile": 90, "login": 5, "signup": 5},
+    "reset": {"reset": 50, "login": 25, "profile": 25},
+}
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Summarizes latencies in seconds as milliseconds.
+
+    Args:
+        samples (List[float]): The latencies, in seconds.
+
+    Returns:
+        Dict[str, float]: The count, mean, p50, p95 and p99, by
+        nearest rank.
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        index = max(0, min(len(ordered) - 1,
+                           int(round(p / 100 * len(ordered))) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+    }
+
+
+class Client:
+    """HTTP/1.1 client keeping one connection to the app."""
+
+    def __init__(self, port: int) -> None:
+        """Initialize the client of the app listening on a port."""
+        self._port = port
+        self._connection = http.client.HTTPConnection(
+            "127.0.0.1", port, timeout=60)
+
+    def request(self, method: str, path: str, form: Dict = None,
+                session_id: str = None) -> Tuple[int, bytes, Any]:
+        """Send a request and read the response.
+
+        Returns:
+            Tuple[int, bytes, Any]: The status, the body and the
+            http.client.HTTPResponse.
+        """
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if session_id is not None:
+            headers["Cookie"] = "session_id={}".format(session_id)
+        try:
+            self._connection.request(method, path, body, headers)
+            response = self._connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            # The server closed the connection, retry on a new one
+            self._connection.close()
+            self._connection = http.client.HTTPConnection(
+                "127.0.0.1", self._port, timeout=60)
+            self._connection.request(method, path, body, headers)
+            response = self._connection.getresponse()
+        return response.status, response.read(), response
+
+
+def session_cookie(response: Any) -> Optional[str]:
+    """Return the session_id cookie set by a response, if any."""
+    cookie = response.getheader("Set-Cookie") or ""
+    name, _, value = cookie.partition(";")[0].partition("=")
+    return value if name.strip() == "session_id" else None
+
+
+class Worker:
+    """A client thread running a seeded mix of operations on its own
+    users, so that their sessions are never replaced by another thread.
+    """
+
+    def __init__(self, index: int, port: int, users: List[Tuple[str, str]],
+                 weights: Dict[str, int], seed: int) -> None:
+        """Initialize the worker.
+
+        Args:
+            index (int): The worker number, making its emails unique.
+            port (int): The port of the app.
+            users (List[Tuple[str, str]]): The registered (email, password)
+                pairs of the worker.
+            weights (Dict[str, int]): The operation weights.
+            seed (int): The seed of the operation mix.
+        """
+        self.index = index
+        self.client = Client(port)
+        self.users = users
+        self.sessions: Dict[str, str] = {}
+        self.random = random.Random(seed * 1000 + index)
+        self.operations = list(weights)
+        self.weights = list(weights.values())
+        self.samples: Dict[str, List[float]] = {}
+        self.errors = 0
+        self.signups = 0
+
+    def timed(self, name: str, expected: int, method: str, path: str,
+              **kwargs: Any) -> Tuple[int, bytes, Any]:
+        """Send a request, recording its latency and whether it failed."""
+        start = time.perf_counter()
+        status, body, response = self.client.request(method, path, **kwargs)
+        self.samples.setdefault(name, []).append(time.perf_counter() - start)
+        if status != expected:
+            self.errors += 1
+        return status, body, response
+
+    def login(self, email: str, password: str, name: str = "login") -> None:
+        """Log a user in, keeping its session."""
+        status, _, response = self.timed(
+            name, 200, "POST", "/sessions",
+            form={"email": email, "password": password})
+        if status == 200:
+            self.sessions[email] = session_cookie(response)
+
+    def signup(self) -> None:
+        """Register a new user."""
+        self.signups += 1
+        self.timed("signup", 200, "POST", "/users", form={
+            "email": "new{}-{}@bench.test".format(self.index, self.signups),
+            "password": "password"})
+
+    def profile(self) -> None:
+        """Read the profile of a logged in user."""
+        email = self.random.choice(list(self.sessions))
+        self.timed("profile", 200, "GET", "/profile",
+                   session_id=self.sessions[email])
+
+    def reset(self) -> None:
+        """Reset the password of a user, to the same one."""
+        email, password = self.random.choice(self.users)
+        status, body, _ = self.timed("reset_token", 200, "POST",
+                                     "/reset_password",
+                                     form={"email": email})
+        if status == 200:
+            self.timed("update_password", 200, "PUT", "/reset_password",
+                       form={"email": email,
+                             "reset_token": json.loads(body)["reset_token"],
+                             "new_password": password})
+
+    def run(self, count: int, start: threading.Barrier) -> None:
+        """Run `count` operations once every worker is ready."""
+        for email, password in self.users:
+            self.login(email, password, name="setup")
+        self.samples.pop("setup", None)
+        start.wait()
+        for operation in self.random.choices(self.operations, self.weights,
+                                             k=count):
+            if operation == "login":
+                self.login(*self.random.choice(self.users))
+            else:
+                getattr(self, operation)()
+
+
+def free_port() -> int:
+    """Return a TCP port free on the loopback interface."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory: str, port: int,
+                 args: argparse.Namespace) -> subprocess.Popen:
+    """Start the app on a port, with its database in a directory, and wait
+    until it answers."""
+    env = dict(os.environ,
+               DB_URL="sqlite:///{}".format(
+                   os.path.join(directory, "bench.db")),
+               BCRYPT_ROUNDS=str(args.rounds),
+               RATE_LIMIT_IP="off", RATE_LIMIT_EMAIL="off",
+               HASHING_MAX_PENDING=str(2 * args.concurrency))
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", str(port)],
+        cwd=directory, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            Client(port).request("GET", "/")
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("the app did not start")
+
+
+def serve(port: int) -> None:
+    """Create the tables, then serve the app with the threaded development
+    server."""
+    from werkzeug.serving import make_server
+    from app import app
+    from db import DB
+
+    DB()
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+def run_profile(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Run a load profile against a fresh app and database.
+
+    Returns:
+        Dict[str, Any]: The throughput, errors and latencies, overall and
+        by operation.
+    """
+    directory = tempfile.mkdtemp(prefix="bench-suite-")
+    port = free_port()
+    server = start_server(directory, port, args)
+    try:
+        setup = Client(port)
+        users = [("user{}@bench.test".format(i), "password{}".format(i))
+                 for i in range(args.users)]
+        for email, password in users:
+            setup.request("POST", "/users",
+                          form={"email": email, "password": password})
+        workers = [Worker(i, port, users[i::args.concurrency],
+                          PROFILES[name], args.seed)
+                   for i in range(args.concurrency)]
+        barrier = threading.Barrier(args.concurrency + 1)
+        threads = [threading.Thread(
+            target=worker.run,
+            args=(args.requests // args.concurrency, barrier))
+            for worker in workers]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    samples: Dict[str, List[float]] = {}
+    for worker in workers:
+        for operation, latencies in worker.samples.items():
+            samples.setdefault(operation, []).extend(latencies)
+    total = sum(len(latencies) for latencies in samples.values())
+    return {
+        "requests": total,
+        "errors": sum(worker.errors for worker in workers),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1),
+        "overall": percentiles(
+            [latency for latencies in samples.values()
+             for latency in latencies]),
+        "operations": {operation: percentiles(latencies)
+                       for operation, latencies in sorted(samples.items())},
+    }
+
+
+def time_each(func: Callable[[int], Any], count: int) -> List[float]:
+    """Return the latency of each of `count` calls of func(i)."""
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_micro(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the micro-benchmarks.
+
+    Returns:
+        Dict[str, Any]: The latencies of filter_datum, hash_password and
+        find_user_by by table size.
+    """
+    os.environ["BCRYPT_ROUNDS"] = str(args.rounds)
+    from bench_filter_datum import make_lines
+    from bench_find_user_by import populate
+    from db import DB
+    from filtered_logger import PII_FIELDS, filter_datum
+    from hashing import hash_password
+
+    results: Dict[str, Any] = {}
+    lines = make_lines(1000)
+    results["filter_datum"] = percentiles(time_each(
+        lambda i: filter_datum(PII_FIELDS, "***", lines[i % 1000], ";"),
+        args.micro_calls))
+    results["hash_password"] = percentiles(time_each(
+        lambda i: hash_password("password{}".format(i)),
+        max(1, args.micro_calls // 100)))
+    results["hash_password"]["rounds"] = args.rounds
+
+    rng = random.Random(args.seed)
+    results["find_user_by"] = {}
+    for size in args.sizes:
+        directory = tempfile.mkdtemp(prefix="bench-suite-")
+        db = DB(url="sqlite:///{}".format(os.path.join(directory, "b.db")))
+        populate(db, size)
+        keys = [rng.randrange(size) for _ in range(args.micro_lookups)]
+
+        def lookup(i: int) -> None:
+            db.find_user_by(email="user{}@example.com".format(keys[i]))
+            db._session.expunge_all()
+
+        results["find_user_by"][str(size)] = percentiles(
+            time_each(lookup, args.micro_lookups))
+        db.close_session()
+        db._engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def metadata(args: argparse.Namespace) -> Dict[str, Any]:
+    """Describe the run, to tell apart the results of different runs."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {key: value for key, value in vars(args).items()
+                 if key not in ("compare", "output")},
+    }
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """Flatten nested results to their numbers by dotted path."""
+    flat = {}
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            threshold: float) -> List[str]:
+    """Print the changes of the latencies and throughputs from a baseline.
+
+    Returns:
+        List[str]: The paths more than `threshold` percent worse.
+    """
+    current = flatten({k: results[k] for k in ("load", "micro")
+                       if k in results})
+    before = flatten({k: baseline[k] for k in ("load", "micro")
+                      if k in baseline})
+    regressions = []
+    for path in sorted(current):
+        if path not in before or not before[path]:
+            continue
+        higher_is_better = path.endswith("throughput_rps")
+        if not (path.endswith("_ms") or higher_is_better):
+            continue
+        change = (current[path] - before[path]) / before[path] * 100
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > threshold:
+            regressions.append(path)
+            flag = "  REGRESSION"
+        print("{:<55} {:>10} -> {:>10} {:>+7.1f}%{}".format(
+            path, before[path], current[path], change, flag))
+    return regressions
+
+
+def main() -> None:
+    """Runs the selected benchmarks and saves their results."""
+    if sys.argv[1:2] == ["serve"]:
+        serve(int(sys.argv[2]))
+        return
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("suite", nargs="?", default="all",
+                        choices=("load", "micro", "all"))
+    parser.add_argument("-p", "--profiles", nargs="+", default=list(PROFILES),
+                        choices=list(PROFILES))
+    parser.add_argument("-n", "--requests", type=int, default=2000,
+                        help="operations per load profile")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-u", "--users", type=int, default=64,
+                        help="users registered before each profile")
+    parser.add_argument("-r", "--rounds", type=int, default=4,
+                        help="bcrypt work factor of the benchmarks")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="users table sizes of find_user_by")
+    parser.add_argument("--micro-calls", type=int, default=10000)
+    parser.add_argument("--micro-lookups", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--compare", help="results of a previous run")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="percent change flagged as a regression")
+    args = parser.parse_args()
+    args.concurrency = min(args.concurrency, args.users)
+
+    results: Dict[str, Any] = {"meta": metadata(args)}
+    if args.suite in ("load", "all"):
+        results["load"] = {}
+        for name in args.profiles:
+            report = results["load"][name] = run_profile(name, args)
+            print("{:<8} {:>8.1f} req/s  p50 {:>7.2f}ms  p95 {:>7.2f}ms  "
+                  "p99 {:>7.2f}ms  errors {}".format(
+                      name, report["throughput_rps"],
+                      report["overall"]["p50_ms"],
+                      report["overall"]["p95_ms"],
+                      report["overall"]["p99_ms"], report["errors"]))
+    if args.suite in ("micro", "all"):
+        results["micro"] = run_micro(args)
+        micro = results["micro"]
+        for name in ("filter_datum", "hash_password"):
+            print("{:<20} p50 {:>9.4f}ms  p99 {:>9.4f}ms".format(
+                name, micro[name]["p50_ms"], micro[name]["p99_ms"]))
+        for size, report in micro["find_user_by"].items():
+            print("{:<20} p50 {:>9.4f}ms  p99 {:>9.4f}ms".format(
+                "find_user_by " + size, report["p50_ms"], report["p99_ms"]))
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print("results saved to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Cache module
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+
+class TTLCache:
+    """Bounded, thread-safe cache with per-entry expiry and LRU eviction.
+
+    Negative results (None) can be cached with their own, usually shorter,
+    time to live. Entries may carry a tag, e.g. the ID of the row they
+    copy, to drop all the entries of a tag at once.
+
+    A reader loading a missed entry takes the generation first and passes
+    it to set, which drops the write if its key or tag was deleted since,
+    so a value read before a change cannot outlive its invalidation.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60,
+                 negative_ttl: float = 5) -> None:
+        """Initialize a new cache.
+
+        Args:
+            maxsize (int): The maximum number of entries.
+            ttl (float): Seconds an entry stays valid.
+            negative_ttl (float): Seconds a None entry stays valid.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any, Any]]" = \
+            OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+        # Generation of the last delete of each key and tag, bounded by
+        # forgetting them all and refusing the writes of older readers
+        self._generation = 0
+        self._floor = 0
+        self._deleted_keys: Dict[Hashable, int] = {}
+        self._deleted_tags: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Look up an entry.
+
+        Args:
+            key (Hashable): The key of the entry.
+
+        Returns:
+            Tuple[bool, Any]: Whether a valid entry was found, and its
+            value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                self._pop(key)
+            self.misses += 1
+            return False, None
+
+    def generation(self) -> int:
+        """Return the generation to pass to set, taken before reading the
+        value of a missed entry."""
+        with self._lock:
+            return self._generation
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None,
+            tag: Hashable = None, generation: Optional[int] = None) -> None:
+        """Store an entry, evicting the least recently used one if full.
+
+        Args:
+            key (Hashable): The key of the entry.
+            value (Any): The value, None for a negative result.
+            ttl (Optional[float]): Seconds the entry stays valid, by default
+                `ttl`, or `negative_ttl` for None.
+            tag (Hashable): The tag of the entry, see delete_tag.
+            generation (Optional[int]): The generation taken before the
+                value was read, the entry is not stored if its key or tag
+                was deleted since.
+        """
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and (
+                    generation < self._floor or
+                    self._deleted_keys.get(key, -1) > generation or
+                    self._deleted_tags.get(tag, -1) > generation):
+                return
+            self._pop(key)
+            self._entries[key] = (time.monotonic() + ttl, value, tag)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key: Hashable) -> None:
+        """Drop an entry if present.
+
+        Args:
+            key (Hashable): The key of the entry.
+        """
+        with self._lock:
+            self._pop(key)
+            self._deleted_keys[key] = self._bump()
+
+    def delete_tag(self, tag: Hashable) -> None:
+        """Drop every entry stored with a tag.
+
+        Args:
+            tag (Hashable): The tag of the entries.
+        """
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._entries.pop(key, None)
+            self._deleted_tags[tag] = self._bump()
+
+    def clear(self) -> None:
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._forget_deletes()
+
+    def _bump(self) -> int:
+        """Start a new generation for a delete, with the lock held."""
+        if len(self._deleted_keys) + len(self._deleted_tags) >= \
+                self.maxsize:
+            self._forget_deletes()
+        self._generation += 1
+        return self._generation
+
+    def _forget_deletes(self) -> None:
+        """Forget the generations of the deletes, refusing the writes of
+        the readers started before, with the lock held."""
+        self._deleted_keys.clear()
+        self._deleted_tags.clear()
+        self._generation += 1
+        self._floor = self._generation
+
+    def _pop(self, key: Hashable) -> None:
+        """Drop an entry and its tag reference, with the lock held."""
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            keys = self._tags[entry[2]]
+            keys.discard(key)
+            if not keys:
+                del self._tags[entry[2]]
+
+    def __len__(self) -> int:
+        """Return the number of entries, expired ones included."""
+        return len(self._entries)
@@ -2,48 +2,268 @@
 """DB module
 """
 import logging
-from typing import Dict
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import (
+    Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple,
+)
 
-from sqlalchemy import create_engine
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy import (
+    bindparam, create_engine, delete, event, inspect, select, update,
+)
+from sqlalchemy.engine import Connection, make_url
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.schema import DDLElement
+from sqlalchemy.sql import Select
 
-from user import Base, User
+from cache import TTLCache
+from user import Base, ResetToken, User
 
-# Disable logging of warnings for cleaner output
-logging.disable(logging.WARNING)
+# Keep the warnings of SQLAlchemy out of the output, and only those
+logging.getLogger("sqlalchemy").setLevel(logging.ERROR)
+
+# Attributes update_user may set and find_user_by may filter on
+USER_COLUMNS = frozenset(column.key for column in inspect(User).column_attrs)
+
+
+class Principal(NamedTuple):
+    """The identity of the user of a session, read without loading a User.
+    """
+    id: int
+    email: str
+
+
+# Core statement of DB.get_session_principal and its async counterpart,
+# run outside of the ORM
+PRINCIPAL_STATEMENT = select(
+    User.__table__.c.id, User.__table__.c.email).where(
+    User.__table__.c.session_id == bindparam("session_id"))
+
+# find_user_by statements by signature, see find_statement
+_find_statements: Dict[Tuple[Tuple[str, bool], ...], Select] = {}
+
+
+def find_statement(signature: Tuple[Tuple[str, bool], ...]) -> Select:
+    """Return the statement selecting the users matching a signature, built
+    once and reused so that its compiled form is cached by SQLAlchemy.
+
+    Args:
+        signature (Tuple[Tuple[str, bool], ...]): The sorted filtered
+            columns, each with whether it is compared to None.
+
+    Returns:
+        Select: The statement, with one bound parameter per column not
+        compared to None.
+    """
+    statement = _find_statements.get(signature)
+    if statement is None:
+        statement = select(User)
+        for key, is_none in signature:
+            column = getattr(User, key)
+            statement = statement.where(
+                column.is_(None) if is_none else column == bindparam(key))
+        _find_statements[signature] = statement
+    return statement
+
+
+class AddColumn(DDLElement):
+    """ALTER TABLE ... ADD COLUMN statement for an existing column model."""
+
+    def __init__(self, table, column) -> None:
+        """Initialize the statement for a column of a table."""
+        self.table = table
+        self.column = column
+
+
+@compiles(AddColumn)
+def _compile_add_column(element: AddColumn, compiler, **kwargs) -> str:
+    """Compile AddColumn with the dialect's column specification."""
+    return "ALTER TABLE {} ADD COLUMN {}".format(
+        compiler.preparer.format_table(element.table),
+        compiler.get_column_specification(element.column))
+
+
+def upgrade_schema(connection: Connection) -> None:
+    """Creates the columns and indexes missing from a database made by an
+    older version of the models, e.g. the unique lookup indexes of an
+    existing a.db. New columns need a server default or to be nullable.
+
+    Args:
+        connection (Connection): A connection to the database to upgrade.
+
+    Raises:
+        IntegrityError: If existing rows break a unique index, they have to
+            be deduplicated first.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        columns = {column["name"]
+                   for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                connection.execute(AddColumn(table, column))
+        existing = {index["name"]
+                    for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+def env_flag(name: str) -> bool:
+    """Read a boolean environment variable: "1", "true", "yes" and "on"
+    are true, unset, empty, "0", "false", "no" and "off" are false.
+
+    Args:
+        name (str): The variable name.
+
+    Raises:
+        ValueError: If the value is none of these.
+    """
+    value = os.getenv(name, "").strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("", "0", "false", "no", "off"):
+        return False
+    raise ValueError("{} is not a boolean: {}".format(name, value))
+
+
+def engine_options(url: str) -> Dict:
+    """Engine configuration for a database URL, from the environment.
+
+    DB_POOL_SIZE and DB_MAX_OVERFLOW size the connection pool (5 and 10 by
+    default), connections are pinged before being reused and SQL is only
+    logged if DB_ECHO is true, see env_flag. SQLite connections may be used
+    by any thread and an in-memory database is shared by all of them.
+
+    Args:
+        url (str): The database URL.
+
+    Returns:
+        Dict: The keyword arguments of create_engine.
+    """
+    options = {
+        "echo": env_flag("DB_ECHO"),
+        "pool_pre_ping": True,
+    }
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+        if parsed.database in (None, "", ":memory:"):
+            options["poolclass"] = StaticPool
+            return options
+        options["poolclass"] = QueuePool
+    options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "5"))
+    options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    return options
+
+
+# Pragmas of the SQLite performance profile, applied to every connection
+SQLITE_PERFORMANCE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+}
+
+
+def enable_sqlite_foreign_keys(dbapi_connection,
+                               connection_record) -> None:
+    """Engine connect event enforcing the foreign keys, e.g. the ON DELETE
+    CASCADE of reset_tokens, which SQLite ignores by default."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Engine connect event setting SQLITE_PERFORMANCE_PRAGMAS."""
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PERFORMANCE_PRAGMAS.items():
+        cursor.execute("PRAGMA {}={}".format(pragma, value))
+    cursor.close()
 
 
 class DB:
     """DB class to manage database interactions.
     """
 
-    def __init__(self, reset: bool = False) -> None:
+    def __init__(self, reset: bool = False, url: str = None,
+                 sqlite_performance: bool = None,
+                 create_schema: bool = True) -> None:
         """Initialize a new DB instance and create tables.
+
+        Args:
+            reset (bool): Drop the tables first.
+            url (str): The database URL, DB_URL or sqlite:///a.db by
+                default.
+            sqlite_performance (bool): Apply SQLITE_PERFORMANCE_PRAGMAS
+                (WAL journal, NORMAL synchronous, busy timeout, mmap and
+                cache sizes) to SQLite connections, by default if
+                DB_SQLITE_PERFORMANCE is true, see env_flag. Foreign keys
+                are enforced on SQLite either way.
+            create_schema (bool): Create the tables, see create_schema.
+                Servers skip it and leave it to an explicit step, e.g.
+                `flask --app app init-db`.
+        """
+        url = url or os.getenv("DB_URL", "sqlite:///a.db")
+        if sqlite_performance is None:
+            sqlite_performance = env_flag("DB_SQLITE_PERFORMANCE")
+        self._engine = create_engine(url, **engine_options(url))
+        if self._engine.dialect.name == "sqlite":
+            event.listen(self._engine, "connect",
+                         enable_sqlite_foreign_keys)
+            if sqlite_performance:
+                event.listen(self._engine, "connect", apply_sqlite_pragmas)
+        if create_schema or reset:
+            self.create_schema(reset)
+        # One session per thread, released by close_session
+        self.__sessions = scoped_session(sessionmaker(bind=self._engine))
+        # Updates pending in the unit of work of each thread
+        self._local = threading.local()
+        # Users and principals by session ID, invalidated by update_user
+        self._session_cache = TTLCache(
+            maxsize=int(os.getenv("SESSION_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("SESSION_CACHE_TTL", "60")),
+            negative_ttl=float(os.getenv("SESSION_CACHE_NEGATIVE_TTL", "5")),
+        )
+
+    def create_schema(self, reset: bool = False) -> None:
+        """Create the missing tables, then their missing columns and
+        indexes, see upgrade_schema.
+
+        Args:
+            reset (bool): Drop the tables first.
         """
-        self._engine = create_engine("sqlite:///a.db", echo=True)
         if reset:
             Base.metadata.drop_all(self._engine)
         Base.metadata.create_all(self._engine)
-        self.__session = None
+        with self._engine.begin() as connection:
+            upgrade_schema(connection)
+
+    def after_fork(self) -> None:
+        """Forget the pooled connections inherited by a forked child,
+        without closing them under the parent."""
+        self._engine.dispose(close=False)
 
     @property
     def _session(self) -> Session:
-        """Memoized session object for database interactions.
+        """Session object of the current thread for database interactions.
         """
-        if self.__session is None:
-            DBSession = sessionmaker(bind=self._engine)
-            self.__session = DBSession()
-        return self.__session
+        return self.__sessions()
 
     def close_session(self) -> None:
-        """Close the current session."""
-        if self.__session:
-            self._session.close()
-            self.__session = None
+        """Close the session of the current thread, e.g. at the end of a
+        request."""
+        self.__sessions.remove()
 
     def add_user(self, email: str, hashed_password: str) -> User:
         """
@@ -56,20 +276,93 @@ class DB:
 
         Returns:
             User: A User object representing the new user.
+
+        Raises:
+            IntegrityError: If the email is already registered.
         """
         new_user = User(email=email, hashed_password=hashed_password)
         try:
             self._session.add(new_user)
             self._session.commit()
+        except IntegrityError:
+            # Duplicate email, left to the caller to report
+            self._session.rollback()
+            raise
         except Exception as e:
             print(f"Error adding user to database: {e}")
             self._session.rollback()
             raise
         return new_user
 
+    def find_existing_emails(self, emails: Iterable[str]) -> Set[str]:
+        """Returns the emails already registered, in a single IN query.
+
+        Args:
+            emails (Iterable[str]): The emails to look for.
+
+        Returns:
+            Set[str]: The emails found in the database.
+        """
+        query = self._session.query(User.email).filter(
+            User.email.in_(list(emails)))
+        return {email for email, in query}
+
+    def add_users_bulk(self, users: Iterable[Dict[str, str]],
+                       chunk_size: int = 1000,
+                       existing: Optional[Set[str]] = None,
+                       ) -> List[Dict[str, str]]:
+        """Adds many users, skipping the emails already registered.
+
+        Each chunk costs one IN query for the existing emails, unless the
+        caller already looked them up, and one bulk insert, committed in a
+        single transaction.
+
+        Args:
+            users (Iterable[Dict[str, str]]): The users to add, as dicts
+                with an email and a hashed_password.
+            chunk_size (int): The number of users per transaction.
+            existing (Optional[Set[str]]): The emails of the users already
+                known to be registered, looked up per chunk if None.
+
+        Returns:
+            List[Dict[str, str]]: The report of each user, in order, with
+            its email and a status of "created" or "duplicate".
+        """
+        users = list(users)
+        report = []
+        seen = set()
+        for start in range(0, len(users), chunk_size):
+            chunk = users[start:start + chunk_size]
+            registered = existing
+            if registered is None:
+                registered = self.find_existing_emails(
+                    user["email"] for user in chunk)
+            rows = []
+            for user in chunk:
+                duplicate = user["email"] in registered or \
+                    user["email"] in seen
+                seen.add(user["email"])
+                if not duplicate:
+                    rows.append({"email": user["email"],
+                                 "hashed_password": user["hashed_password"]})
+                report.append({
+                    "email": user["email"],
+                    "status": "duplicate" if duplicate else "created",
+                })
+            try:
+                self._session.bulk_insert_mappings(User, rows)
+                self._session.commit()
+            except Exception:
+                self._session.rollback()
+                raise
+        return report
+
     def find_user_by(self, **kwargs) -> User:
         """Find a user in the database using arbitrary keyword arguments.
 
+        The statement of each set of filtered columns is built once, see
+        find_statement, and unknown columns are rejected before any SQL.
+
         Args:
             **kwargs: Arbitrary keyword arguments to filter the query.
 
@@ -80,47 +373,315 @@ class DB:
             NoResultFound: If no user matches the criteria.
             InvalidRequestError: If invalid query arguments are passed.
         """
-        session = self._session
+        for key in kwargs:
+            if key not in USER_COLUMNS:
+                raise InvalidRequestError(
+                    "User has no attribute {}".format(key))
+        signature = tuple((key, kwargs[key] is None)
+                          for key in sorted(kwargs))
+        params = {key: value for key, value in kwargs.items()
+                  if value is not None}
         try:
-            user = self._session.query(User).filter_by(**kwargs).one()
+            user = self._session.execute(
+                find_statement(signature), params).scalar_one()
         except NoResultFound:
             raise NoResultFound()
-        except InvalidRequestError:
-            raise InvalidRequestError()
         return user
 
+    def find_user_by_session_id(self, session_id: str) -> Optional[User]:
+        """Find the user of a session, through the session cache.
+
+        Cached users are detached copies, so reading them never issues SQL.
+        Unknown session IDs are cached too, for a shorter time. A user read
+        before a concurrent update of it is not cached, see TTLCache.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            Optional[User]: A detached copy of the user, None if no user
+            has this session ID.
+        """
+        found, user = self._session_cache.get(session_id)
+        if found:
+            return user
+        generation = self._session_cache.generation()
+        try:
+            user = detached_copy(self.find_user_by(session_id=session_id))
+        except NoResultFound:
+            user = None
+        self._session_cache.set(session_id, user,
+                                tag=user.id if user is not None else None,
+                                generation=generation)
+        return user
+
+    def get_session_principal(self, session_id: str) -> Optional[Principal]:
+        """Read the id and email of the user of a session.
+
+        Like find_user_by_session_id, but the columns are read by a Core
+        statement on the session's connection: no User is built and the
+        identity map is never touched.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            Optional[Principal]: The user's id and email, None if no user
+            has this session ID.
+        """
+        key = ("principal", session_id)
+        found, principal = self._session_cache.get(key)
+        if found:
+            return principal
+        generation = self._session_cache.generation()
+        row = self._session.connection().execute(
+            PRINCIPAL_STATEMENT, {"session_id": session_id}).first()
+        principal = Principal(*row) if row is not None else None
+        self._session_cache.set(
+            key, principal,
+            tag=principal.id if principal is not None else None,
+            generation=generation)
+        return principal
+
+    def get_session_version(self, user_id: int) -> Optional[int]:
+        """Read the session version of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            Optional[int]: The version, None if the user does not exist.
+        """
+        return self._session.query(User.session_version).filter(
+            User.id == user_id).scalar()
+
+    def bump_session_version(self, user_id: int) -> None:
+        """Increment the session version of a user in a single UPDATE,
+        revoking its signed session tokens.
+
+        Args:
+            user_id (int): The ID of the user.
+        """
+        self._session.query(User).filter(User.id == user_id).update(
+            {User.session_version: User.session_version + 1},
+            synchronize_session=False)
+        self._session.commit()
+
+    def add_reset_token(self, user_id: int, token_hash: str,
+                        expires_at: int) -> None:
+        """Store the reset token of a user, replacing its previous ones.
+
+        Args:
+            user_id (int): The ID of the user.
+            token_hash (str): The digest of the token.
+            expires_at (int): The Unix time the token expires at.
+        """
+        try:
+            self._session.execute(delete(ResetToken).where(
+                ResetToken.user_id == user_id))
+            self._session.add(ResetToken(token_hash=token_hash,
+                                         user_id=user_id,
+                                         expires_at=expires_at))
+            self._session.commit()
+        except BaseException:
+            self._session.rollback()
+            raise
+
+    def find_reset_token(self, token_hash: str) -> Optional[int]:
+        """Look up an unexpired reset token by its primary key.
+
+        Args:
+            token_hash (str): The digest of the token.
+
+        Returns:
+            Optional[int]: The ID of the token's user, None if the token is
+            unknown or expired.
+        """
+        return self._session.query(ResetToken.user_id).filter(
+            ResetToken.token_hash == token_hash,
+            ResetToken.expires_at > int(time.time())).scalar()
+
+    def redeem_reset_token(self, token_hash: str, user_id: int,
+                           **kwargs) -> None:
+        """Consume a reset token and update its user in one transaction,
+        so a token changes the user at most once.
+
+        Args:
+            token_hash (str): The digest of the token.
+            user_id (int): The ID of the token's user.
+            **kwargs: The attributes of the user to update.
+
+        Raises:
+            ValueError: If the token was used or expired in the meantime.
+        """
+        with self.unit_of_work():
+            result = self._session.execute(delete(ResetToken).where(
+                ResetToken.token_hash == token_hash,
+                ResetToken.user_id == user_id,
+                ResetToken.expires_at > int(time.time())))
+            if result.rowcount == 0:
+                raise ValueError("Invalid reset token")
+            self.update_user(user_id, **kwargs)
+
+    def purge_expired_reset_tokens(self, batch_size: int = 1000) -> int:
+        """Delete the expired reset tokens, one transaction per batch so
+        that writers are never locked out for long.
+
+        Args:
+            batch_size (int): The number of tokens per batch.
+
+        Returns:
+            int: The number of tokens deleted.
+        """
+        now = int(time.time())
+        purged = 0
+        while True:
+            batch = [token_hash for token_hash, in self._session.query(
+                ResetToken.token_hash).filter(
+                ResetToken.expires_at <= now).limit(batch_size)]
+            if not batch:
+                return purged
+            try:
+                self._session.execute(delete(ResetToken).where(
+                    ResetToken.token_hash.in_(batch)))
+                self._session.commit()
+            except BaseException:
+                self._session.rollback()
+                raise
+            purged += len(batch)
+            if len(batch) < batch_size:
+                return purged
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[None]:
+        """Batch the update_user calls of a block into one transaction.
+
+        The updates of a user are merged and written by a single UPDATE
+        when the block exits, then everything is committed at once, or
+        nothing if the block raises. Reads in the block do not see the
+        pending updates. Nested blocks join the outermost one.
+
+        Raises:
+            ValueError: If an updated user does not exist.
+        """
+        if getattr(self._local, "pending", None) is not None:
+            yield
+            return
+        self._local.pending = pending = {}
+        try:
+            yield
+            for user_id, values in pending.items():
+                self._update(user_id, values)
+            self._session.commit()
+        except BaseException:
+            self._session.rollback()
+            raise
+        finally:
+            self._local.pending = None
+            self._invalidate(pending)
+
     def update_user(self, user_id: int, **kwargs) -> None:
         """Updates a user's attributes by user ID and arbitrary keyword
         arguments.
 
+        Only the given columns are written, by a single UPDATE ... WHERE id,
+        committed at once or at the end of the current unit_of_work.
+
         Args:
             user_id (int): The ID of the user to update.
             **kwargs: Keyword arguments representing the user's attributes to
             update.
 
         Raises:
-            ValueError: If an invalid attribute is passed in kwargs.
+            ValueError: If the user does not exist or an invalid attribute
+                is passed in kwargs.
 
         Returns:
             None
         """
+        for key in kwargs:
+            if key not in USER_COLUMNS:
+                raise ValueError("User has no attribute {}".format(key))
+        if not kwargs:
+            return
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending.setdefault(user_id, {}).update(kwargs)
+            return
         try:
-            # Find the user with the given user ID
-            user = self.find_user_by(id=user_id)
-        except NoResultFound:
+            self._update(user_id, kwargs)
+            self._session.commit()
+        except BaseException:
+            self._session.rollback()
+            raise
+        finally:
+            self._invalidate({user_id: kwargs})
+
+    def _update(self, user_id: int, values: Dict) -> None:
+        """Issue the UPDATE of a user, without committing it.
+
+        Raises:
+            ValueError: If the user does not exist.
+        """
+        result = self._session.execute(
+            update(User).where(User.id == user_id).values(**values)
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 0:
             raise ValueError("User with id {} not found".format(user_id))
 
-        # Update user's attributes
-        for key, value in kwargs.items():
-            if not hasattr(user, key):
-                # Raise error if an argument that does not correspond to a user
-                # attribute is passed
-                raise ValueError("User has no attribute {}".format(key))
-            setattr(user, key, value)
+    def _invalidate(self, updates: Dict[int, Dict]) -> None:
+        """Drop the cached sessions of updated users.
 
-        try:
-            # Commit changes to the database
-            self._session.commit()
-        except InvalidRequestError:
-            # Raise error if an invalid request is made
-            raise ValueError("Invalidi request")
+        Cached copies of a user go stale whatever changes, and a new
+        session ID may have been cached as unknown.
+        """
+        for user_id, values in updates.items():
+            self._session_cache.delete_tag(user_id)
+            if values.get("session_id") is not None:
+                self._session_cache.delete(values["session_id"])
+                self._session_cache.delete(
+                    ("principal", values["session_id"]))
+
+
+class ResetTokenSweeper(threading.Thread):
+    """Daemon thread purging the expired reset tokens of a database at a
+    fixed interval.
+    """
+
+    def __init__(self, db: DB, interval: float = 300,
+                 batch_size: int = 1000) -> None:
+        """Initialize the sweeper, started with start().
+
+        Args:
+            db (DB): The database to sweep.
+            interval (float): Seconds between two sweeps.
+            batch_size (int): The number of tokens deleted per transaction.
+        """
+        super().__init__(name="reset-token-sweeper", daemon=True)
+        self._db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        """Sweep until stopped."""
+        while not self._stopped.wait(self.interval):
+            try:
+                self._db.purge_expired_reset_tokens(self.batch_size)
+            except Exception:
+                logging.getLogger(__name__).exception("sweep failed")
+            finally:
+                self._db.close_session()
+
+    def stop(self) -> None:
+        """Stop sweeping and wait for the thread to finish."""
+        self._stopped.set()
+        self.join()
+
+
+def detached_copy(user: User) -> User:
+    """Copy a user into a transient User bound to no session."""
+    return User(id=user.id, email=user.email,
+                hashed_password=user.hashed_password,
+                session_id=user.session_id, reset_token=user.reset_token,
+                session_version=user.session_version)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""Hashing module
+
+Work factor policy of the bcrypt password hashes, mirrored by
+0x00-personal_data/encrypt_password.py. The work factor is read from the
+BCRYPT_ROUNDS environment variable, bcrypt's default of 12 otherwise. It is
+calibrated on the target machine by an explicit step, `./hashing.py`, whose
+output is exported as BCRYPT_ROUNDS, so every process and worker uses the
+same cost and no calibration runs under live load.
+
+Hashing and checking run on the bounded worker pool of a HashingService so
+that a burst of signups or logins cannot pin every request worker.
+"""
+import asyncio
+import functools
+import math
+import os
+import threading
+import time
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor,
+)
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import bcrypt
+
+# Work factor bounds of the calibrator, the floor being bcrypt's default
+MIN_ROUNDS = 12
+MAX_ROUNDS = 31
+
+
+def calibrate_rounds(target_ms: float = 250) -> int:
+    """Benchmarks bcrypt on the current machine and returns the highest
+    work factor whose hashing time stays under the target latency.
+
+    Args:
+        target_ms (float): Target hashing latency in milliseconds.
+
+    Returns:
+        int: The work factor, at least MIN_ROUNDS.
+    """
+    target = target_ms / 1000
+    rounds = MIN_ROUNDS
+    elapsed = _time_hash(rounds)
+    # Each extra round doubles the hashing time
+    while rounds < MAX_ROUNDS and elapsed * 2 <= target:
+        rounds += 1
+        elapsed = _time_hash(rounds)
+    return rounds - 1 if elapsed > target and rounds > MIN_ROUNDS else rounds
+
+
+def _time_hash(rounds: int) -> float:
+    """Returns the time taken to hash a password with the given rounds."""
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds))
+    return time.perf_counter() - start
+
+
+def bcrypt_rounds() -> int:
+    """Work factor used for new hashes, from BCRYPT_ROUNDS or MIN_ROUNDS.
+
+    An explicit BCRYPT_ROUNDS is used as it is, e.g. 4 for the benchmarks.
+    """
+    rounds = os.getenv("BCRYPT_ROUNDS")
+    return int(rounds) if rounds else MIN_ROUNDS
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    """Hashes a password with the current work factor.
+
+    Args:
+        password (str): The password to be hashed.
+        rounds (Optional[int]): The work factor, bcrypt_rounds() if None,
+            passed by the caller when hashing in a worker process.
+
+    Returns:
+        str: The hashed password.
+    """
+    if rounds is None:
+        rounds = bcrypt_rounds()
+    return bcrypt.hashpw(password.encode("utf-8"),
+                         bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def check_password(password: str, hashed_password: str) -> bool:
+    """Checks a password against its hash.
+
+    Args:
+        password (str): The password to check.
+        hashed_password (str): The stored hash.
+
+    Returns:
+        bool: True if the password matches the hash.
+    """
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode("utf-8")
+    return bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """Tells whether a hash was made with a work factor below the current
+    one, e.g. "$2b$10$..." when bcrypt_rounds() is 12.
+    """
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode("utf-8")
+    return int(hashed_password.split("$")[2]) < bcrypt_rounds()
+
+
+class Saturated(Exception):
+    """Raised when the hashing service has no room for another job."""
+
+    def __init__(self, retry_after: int) -> None:
+        """Initializes the error.
+
+        Args:
+            retry_after (int): Seconds after which to try again.
+        """
+        super().__init__("hashing service saturated")
+        self.retry_after = retry_after
+
+
+def _timed(func: Callable, *args: Any) -> Tuple[Any, float]:
+    """Runs a function and returns its result with its duration."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class HashingService:
+    """Bounded worker pool for the bcrypt operations.
+
+    At most `workers` jobs run at once and at most `max_pending` more wait
+    for a worker. A job beyond that raises Saturated instead of queueing.
+    """
+
+    def __init__(self, workers: Optional[int] = None,
+                 max_pending: Optional[int] = None,
+                 processes: bool = False) -> None:
+        """Initializes the service.
+
+        Args:
+            workers (int): Number of workers, HASHING_WORKERS or the CPU
+                count by default.
+            max_pending (int): Number of jobs allowed to wait for a worker,
+                HASHING_MAX_PENDING or four per worker by default.
+            processes (bool): Use worker processes instead of threads,
+                bcrypt releases the GIL so threads are usually enough. The
+                work factor is read in this process and passed to them.
+        """
+        if workers is None:
+            workers = int(os.getenv("HASHING_WORKERS", os.cpu_count() or 1))
+        if max_pending is None:
+            max_pending = int(os.getenv("HASHING_MAX_PENDING", 4 * workers))
+        self.workers = workers
+        self.max_pending = max_pending
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._executor: Executor = pool(max_workers=workers)
+        self._lock = threading.Lock()
+        # Notified when a job finishes, for the batch jobs waiting for room
+        self._room = threading.Condition(self._lock)
+        self._in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._listeners: List[Callable[[str, float], None]] = []
+
+    def add_listener(self, listener: Callable[[str, float], None]) -> None:
+        """Registers a function called with the name and the duration of
+        each completed job, e.g. to export them, once however many times
+        it is registered.
+
+        Args:
+            listener (Callable[[str, float], None]): The function, called
+                from the worker threads.
+        """
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def _done(self, name: str, future: Future) -> None:
+        """Releases the slot of a finished job and records its latency."""
+        with self._lock:
+            self._in_flight -= 1
+            self._room.notify_all()
+            if future.exception() is not None:
+                return
+            elapsed = future.result()[1]
+            self.completed += 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+        for listener in self._listeners:
+            listener(name, elapsed)
+
+    def retry_after(self) -> int:
+        """Estimates the seconds needed to drain the current jobs."""
+        with self._lock:
+            mean = self.latency_total / self.completed if self.completed \
+                else 0.25
+            in_flight = self._in_flight
+        return max(1, math.ceil(in_flight * mean / self.workers))
+
+    def run(self, func: Callable, *args: Any) -> Any:
+        """Runs a function on the pool and waits for its result.
+
+        Args:
+            func (Callable): A module level function, e.g. hash_password.
+            *args: Its arguments.
+
+        Raises:
+            Saturated: If all workers are busy and the queue is full.
+
+        Returns:
+            Any: The result of the function.
+        """
+        return self._submit(func, *args).result()[0]
+
+    async def run_async(self, func: Callable, *args: Any) -> Any:
+        """Runs a function on the pool without blocking the event loop.
+
+        Args:
+            func (Callable): A module level function, e.g. hash_password.
+            *args: Its arguments.
+
+        Raises:
+            Saturated: If all workers are busy and the queue is full.
+
+        Returns:
+            Any: The result of the function.
+        """
+        result, _ = await asyncio.wrap_future(self._submit(func, *args))
+        return result
+
+    def _submit(self, func: Callable, *args: Any) -> Future:
+        """Submits a timed job if there is room for it.
+
+        Raises:
+            Saturated: If all workers are busy and the queue is full.
+        """
+        with self._lock:
+            saturated = self._in_flight >= self.workers + self.max_pending
+            if saturated:
+                self.rejected += 1
+            else:
+                self._in_flight += 1
+        if saturated:
+            raise Saturated(self.retry_after())
+        future = self._executor.submit(_timed, func, *args)
+        future.add_done_callback(
+            functools.partial(self._done, func.__name__))
+        return future
+
+    def hash_password(self, password: str) -> str:
+        """Hashes a password on the pool, see hash_password."""
+        return self.run(hash_password, password, bcrypt_rounds())
+
+    async def hash_password_async(self, password: str) -> str:
+        """Hashes a password on the pool without blocking the event loop,
+        see hash_password."""
+        return await self.run_async(hash_password, password,
+                                    bcrypt_rounds())
+
+    def check_password(self, password: str, hashed_password: str) -> bool:
+        """Checks a password on the pool, see check_password."""
+        return self.run(check_password, password, hashed_password)
+
+    def hash_passwords(self, passwords: Sequence[str]) -> List[str]:
+        """Hashes many passwords in parallel, for batch imports.
+
+        A batch job only starts on an idle worker: it waits, instead of
+        raising Saturated, until fewer than `workers` jobs are in flight.
+        The `max_pending` queue stays free for the interactive jobs, which
+        wait for at most one batch job per worker.
+
+        Args:
+            passwords (Sequence[str]): The passwords to be hashed.
+
+        Returns:
+            List[str]: The hashed passwords, in order.
+        """
+        rounds = bcrypt_rounds()
+        futures = []
+        for password in passwords:
+            with self._room:
+                self._room.wait_for(lambda: self._in_flight < self.workers)
+                self._in_flight += 1
+            future = self._executor.submit(_timed, hash_password, password,
+                                           rounds)
+            future.add_done_callback(
+                functools.partial(self._done, hash_password.__name__))
+            futures.append(future)
+        return [future.result()[0] for future in futures]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Returns the queue depth and hash latency metrics."""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "queue_depth": max(0, self._in_flight - self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "latency_seconds_total": self.latency_total,
+                "latency_seconds_max": self.latency_max,
+            }
+
+    def shutdown(self) -> None:
+        """Waits for the running jobs and stops the workers."""
+        self._executor.shutdown()
+
+
+_service: Optional[HashingService] = None
+_service_lock = threading.Lock()
+
+
+def _forget_service() -> None:
+    """Drops the service inherited by a forked child, whose workers did
+    not survive the fork."""
+    global _service, _service_lock
+    _service = None
+    _service_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_service)
+
+
+def get_service() -> HashingService:
+    """Returns the shared HashingService, created on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = HashingService()
+    return _service
+
+
+if __name__ == "__main__":
+    # Calibrates against BCRYPT_TARGET_MS, e.g. `export $(./hashing.py)`
+    print("BCRYPT_ROUNDS={}".format(calibrate_rounds(
+        float(os.getenv("BCRYPT_TARGET_MS", "250")))))
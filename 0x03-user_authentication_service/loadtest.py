@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Load test of a running instance of the app, reporting requests per second.
+
+Usage: ./loadtest.py [URL] [-c CONNECTIONS] [-n REQUESTS] [-p PATH]
+
+Compare the Flask and the ASGI apps by serving each in turn, e.g.
+`flask --app app init-db && gunicorn -w 4 --threads 32 app:app` and
+`hypercorn -w 4 async_app:app`, then running the same load test. Needs
+httpx.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+
+async def login(client: httpx.AsyncClient) -> None:
+    """Registers a throwaway user and logs it in, keeping the cookie."""
+    credentials = {"email": "{}@loadtest.com".format(uuid.uuid4()),
+                   "password": "loadtest"}
+    await client.post("/users", data=credentials)
+    response = await client.post("/sessions", data=credentials)
+    response.raise_for_status()
+
+
+async def hammer(client: httpx.AsyncClient, path: str, count: int,
+                 statuses: dict) -> None:
+    """Sends `count` GET requests to `path`, counting the statuses."""
+    for _ in range(count):
+        try:
+            status = (await client.get(path)).status_code
+        except httpx.HTTPError:
+            status = "error"
+        statuses[status] = statuses.get(status, 0) + 1
+
+
+async def run(url: str, connections: int, requests: int, path: str) -> None:
+    """Runs the load test and prints the throughput."""
+    limits = httpx.Limits(max_connections=connections,
+                          max_keepalive_connections=connections)
+    async with httpx.AsyncClient(base_url=url, limits=limits,
+                                 timeout=60) as client:
+        await login(client)
+        statuses: dict = {}
+        per_task = max(1, requests // connections)
+        start = time.perf_counter()
+        await asyncio.gather(*(hammer(client, path, per_task, statuses)
+                               for _ in range(connections)))
+        elapsed = time.perf_counter() - start
+    total = per_task * connections
+    print("{} GET {}: {} requests, {} connections, {:.2f}s, "
+          "{:.0f} req/s, statuses {}".format(
+              url, path, total, connections, elapsed, total / elapsed,
+              statuses))
+
+
+def main() -> None:
+    """Parses the arguments and runs the load test."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("url", nargs="?", default="http://localhost:5000")
+    parser.add_argument("-c", "--connections", type=int, default=500)
+    parser.add_argument("-n", "--requests", type=int, default=20000)
+    parser.add_argument("-p", "--path", default="/profile")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.connections, args.requests, args.path))
+
+
+if __name__ == "__main__":
+    main()
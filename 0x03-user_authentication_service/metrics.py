@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""Metrics module
+
+Instrumentation exported in the Prometheus text format:
+1. Counter, Histogram and Callback: the metric types, recorded into
+   per-thread shards so that recording never takes a lock, and merged
+   when scraped. The shard of a finished thread is folded into a shared
+   base, so short-lived threads leave nothing behind
+2. instrument_app and instrument_async_app: per-route latency and SQL
+   statements per request of a Flask or Quart app, and its /metrics route
+3. instrument_engine: latency of the SQL statements
+4. instrument_hasher: duration of the bcrypt operations and the queue of
+   the hashing service
+"""
+import abc
+import bisect
+import itertools
+import threading
+import time
+import weakref
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import hashing
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    """Escape a label value of the text format."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str],
+            extra: str = "") -> str:
+    """Render the labels of a sample, e.g. {route="/",le="0.1"}."""
+    pairs = ['{}="{}"'.format(name, _escape(str(value)))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    """Render a sample value, integers without a decimal point."""
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+Cells = Dict[Tuple[str, ...], List[float]]
+
+
+def _add(into: Cells, cells: Cells) -> None:
+    """Add cells, by label values, to a sum of cells."""
+    for labelvalues, cell in list(cells.items()):
+        total = into.get(labelvalues)
+        if total is None:
+            into[labelvalues] = list(cell)
+        else:
+            for i, value in enumerate(cell):
+                total[i] += value
+
+
+class _Holder:
+    """Thread-local owner of the shard of a thread, collected when the
+    thread ends."""
+
+    __slots__ = ("shard", "__weakref__")
+
+
+class Metric(abc.ABC):
+    """Base of the metric types: a named family of samples, one per set of
+    label values, recorded into the shard of the recording thread.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        """Initialize the metric.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text.
+            labelnames (Sequence[str]): The label names, the values being
+                passed in the same order when recording.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        # Shards of the live threads by key, and the sum of the others
+        self._shards: Dict[int, Cells] = {}
+        self._base: Cells = {}
+        # Keys of the shards of finished threads, appended without the
+        # lock by the finalizer of their holder
+        self._retired: List[int] = []
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Cells:
+        """Return the shard of the current thread, created on first use."""
+        try:
+            return self._local.holder.shard
+        except AttributeError:
+            holder = _Holder()
+            holder.shard = {}
+            with self._lock:
+                self._fold()
+                key = next(self._keys)
+                self._shards[key] = holder.shard
+            weakref.finalize(holder, self._retired.append, key)
+            self._local.holder = holder
+            return holder.shard
+
+    def _fold(self) -> None:
+        """Add the shards of the finished threads to the base, with the
+        lock held."""
+        while self._retired:
+            _add(self._base, self._shards.pop(self._retired.pop()))
+
+    def _merged(self) -> Cells:
+        """Return the sum of the shards, by label values."""
+        merged: Cells = {}
+        with self._lock:
+            self._fold()
+            _add(merged, self._base)
+            shards = list(self._shards.values())
+        for shard in shards:
+            _add(merged, shard)
+        return merged
+
+    def _header(self) -> List[str]:
+        """Return the HELP and TYPE lines."""
+        return ["# HELP {} {}".format(self.name, self.documentation),
+                "# TYPE {} {}".format(self.name, self.type)]
+
+    @abc.abstractmethod
+    def render(self) -> List[str]:
+        """Return the lines of the metric in the text format."""
+
+
+class Counter(Metric):
+    """Monotonic total, e.g. of requests."""
+
+    type = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        """Add to the total of some label values.
+
+        Args:
+            *labelvalues (str): The label values, in labelnames order.
+            amount (float): The increment.
+        """
+        shard = self._shard()
+        cell = shard.get(labelvalues)
+        if cell is None:
+            cell = shard[labelvalues] = [0.0]
+        cell[0] += amount
+
+    def render(self) -> List[str]:
+        """See Metric.render."""
+        lines = self._header()
+        for labelvalues, (value,) in sorted(self._merged().items()):
+            lines.append("{}{} {}".format(
+                self.name, _labels(self.labelnames, labelvalues),
+                _number(value)))
+        return lines
+
+
+class Histogram(Metric):
+    """Distribution of observations, e.g. of latencies, in buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        """Initialize the histogram.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text.
+            labelnames (Sequence[str]): The label names.
+            buckets (Sequence[float]): The sorted upper bounds of the
+                buckets, without +Inf.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        """Record an observation of some label values.
+
+        Args:
+            value (float): The observation.
+            *labelvalues (str): The label values, in labelnames order.
+        """
+        shard = self._shard()
+        cell = shard.get(labelvalues)
+        if cell is None:
+            # A count per bucket, +Inf included, then the sum
+            cell = shard[labelvalues] = [0.0] * (len(self.buckets) + 2)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def render(self) -> List[str]:
+        """See Metric.render."""
+        lines = self._header()
+        bounds = [_number(bound) for bound in self.buckets] + ["+Inf"]
+        for labelvalues, cell in sorted(self._merged().items()):
+            count = 0.0
+            for bound, bucket in zip(bounds, cell):
+                count += bucket
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    _labels(self.labelnames, labelvalues,
+                            'le="{}"'.format(bound)),
+                    _number(count)))
+            labels = _labels(self.labelnames, labelvalues)
+            lines.append("{}_sum{} {}".format(
+                self.name, labels, _number(cell[-1])))
+            lines.append("{}_count{} {}".format(
+                self.name, labels, _number(count)))
+        return lines
+
+
+class Callback(Metric):
+    """Value read when scraped, e.g. a queue depth kept elsewhere."""
+
+    def __init__(self, name: str, documentation: str,
+                 callback: Callable[[], float],
+                 type: str = "gauge") -> None:
+        """Initialize the metric.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text.
+            callback (Callable[[], float]): Returns the current value.
+            type (str): The metric type, "gauge" or "counter".
+        """
+        super().__init__(name, documentation)
+        self.type = type
+        self._callback = callback
+
+    def render(self) -> List[str]:
+        """See Metric.render."""
+        return self._header() + ["{} {}".format(
+            self.name, _number(self._callback()))]
+
+
+class Registry:
+    """The metrics exported together, by name."""
+
+    def __init__(self) -> None:
+        """Initialize an empty registry."""
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric, replacing the one of the same name.
+
+        Args:
+            metric (Metric): The metric.
+
+        Returns:
+            Metric: The metric.
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Latency of the HTTP requests.",
+    ("method", "route", "status")))
+REQUEST_QUERIES = REGISTRY.register(Histogram(
+    "http_request_queries", "SQL statements run by an HTTP request.",
+    ("method", "route"), buckets=(0, 1, 2, 3, 5, 8, 13, 21)))
+SQL_LATENCY = REGISTRY.register(Histogram(
+    "db_statement_duration_seconds", "Latency of the SQL statements.",
+    ("operation",)))
+HASH_LATENCY = REGISTRY.register(Histogram(
+    "password_hash_duration_seconds",
+    "Duration of the bcrypt operations on the hashing service.",
+    ("operation",), buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)))
+
+# SQL statements run by the current request, None outside of requests
+_request_queries: ContextVar[Optional[List[int]]] = ContextVar(
+    "request_queries", default=None)
+
+# Operation labels of the SQL statements, any other being "OTHER"
+_OPERATIONS = frozenset(("SELECT", "INSERT", "UPDATE", "DELETE"))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany) -> None:
+    """Engine event starting the clock of a statement, on its execution
+    context so that a failed statement leaves nothing behind."""
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany) -> None:
+    """Engine event recording the latency of a statement."""
+    start = getattr(context, "_metrics_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    operation = statement.lstrip()[:6].upper()
+    SQL_LATENCY.observe(
+        elapsed, operation if operation in _OPERATIONS else "OTHER")
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+def instrument_engine(engine: Any = None) -> None:
+    """Time the SQL statements of an engine.
+
+    Args:
+        engine (Any): The engine, every engine by default.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    engine = engine or Engine
+    if not event.contains(engine, "before_cursor_execute",
+                          _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _observe_hash(name: str, elapsed: float) -> None:
+    """Hashing service listener recording the duration of an operation."""
+    HASH_LATENCY.observe(elapsed, name)
+
+
+def instrument_hasher(service: hashing.HashingService = None) -> None:
+    """Time the bcrypt operations of a hashing service and export its
+    queue. Instrumenting a service again, e.g. when the app's Auth is
+    rebuilt, only moves the queue metrics to it.
+
+    Args:
+        service (hashing.HashingService): The service, the shared one by
+            default.
+    """
+    service = service or hashing.get_service()
+    service.add_listener(_observe_hash)
+    REGISTRY.register(Callback(
+        "password_hash_in_flight",
+        "bcrypt operations running or queued on the hashing service.",
+        lambda: service.metrics()["in_flight"]))
+    REGISTRY.register(Callback(
+        "password_hash_queue_depth",
+        "bcrypt operations waiting for a worker of the hashing service.",
+        lambda: service.metrics()["queue_depth"]))
+    REGISTRY.register(Callback(
+        "password_hash_rejected_total",
+        "bcrypt operations rejected by the saturated hashing service.",
+        lambda: service.metrics()["rejected"], type="counter"))
+
+
+def _start_request(g: Any) -> None:
+    """Start the clock and the statement count of a request."""
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = [0]
+    _request_queries.set(g.metrics_queries)
+
+
+def _record_request(g: Any, request: Any, status: int) -> None:
+    """Record the latency and statement count of a request, once."""
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        # The rule, not the path, so that the labels stay bounded
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.observe(time.perf_counter() - start, request.method,
+                                route, str(status))
+        REQUEST_QUERIES.observe(g.metrics_queries[0], request.method, route)
+
+
+def instrument_app(app: Any, path: str = "/metrics") -> None:
+    """Time the requests of a Flask app, count their SQL statements and
+    serve the metrics.
+
+    Args:
+        app (Any): The Flask app.
+        path (str): The route of the metrics.
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request_metrics() -> None:
+        """Start the clock and the statement count of a request."""
+        _start_request(g)
+
+    @app.after_request
+    def record_request_metrics(response: Any) -> Any:
+        """Record the latency and statement count of a request."""
+        _record_request(g, request, response.status_code)
+        return response
+
+    @app.teardown_request
+    def stop_request_metrics(exception: BaseException = None) -> None:
+        """Record a request that failed before its response was, then stop
+        counting the statements of the request's thread."""
+        _record_request(g, request, 500)
+        _request_queries.set(None)
+
+    def metrics() -> Any:
+        """GET /metrics
+        Return:
+            The metrics in the Prometheus text format.
+        """
+        return Response(REGISTRY.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule(path, "metrics", metrics, methods=["GET"])
+
+
+def instrument_async_app(app: Any, path: str = "/metrics") -> None:
+    """Time the requests of a Quart app, count their SQL statements and
+    serve the metrics, see instrument_app.
+
+    Args:
+        app (Any): The Quart app.
+        path (str): The route of the metrics.
+    """
+    from quart import Response, g, request
+
+    @app.before_request
+    async def start_request_metrics() -> None:
+        """Start the clock and the statement count of a request."""
+        _start_request(g)
+
+    @app.after_request
+    async def record_request_metrics(response: Any) -> Any:
+        """Record the latency and statement count of a request."""
+        _record_request(g, request, response.status_code)
+        return response
+
+    @app.teardown_request
+    async def stop_request_metrics(exception: BaseException = None) -> None:
+        """Record a request that failed before its response was, then stop
+        counting the statements of the request's task."""
+        _record_request(g, request, 500)
+        _request_queries.set(None)
+
+    async def metrics() -> Any:
+        """GET /metrics
+        Return:
+            The metrics in the Prometheus text format.
+        """
+        return Response(REGISTRY.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule(path, "metrics", metrics, methods=["GET"])
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Rate limit module
+
+Limiters throttling the attempts on the expensive endpoints, e.g. the
+logins which each cost a bcrypt check, by client IP or by email:
+1. MemoryRateLimiter: in-process token buckets, for a single process
+2. RedisRateLimiter: sliding windows on a Redis-protocol server, shared by
+   every worker
+Both keep a constant amount of state per key and forget idle keys.
+"""
+import abc
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class RateLimited(Exception):
+    """Raised when a key has used up its attempts."""
+
+    def __init__(self, retry_after: int) -> None:
+        """Initializes the error.
+
+        Args:
+            retry_after (int): Seconds after which to try again.
+        """
+        super().__init__("rate limit exceeded")
+        self.retry_after = retry_after
+
+
+class RateLimiter(abc.ABC):
+    """Interface of the limiters: at most `limit` attempts per key in any
+    `period` seconds.
+    """
+
+    def __init__(self, limit: int, period: float) -> None:
+        """Initialize the limiter.
+
+        Args:
+            limit (int): The attempts allowed per period.
+            period (float): The period in seconds.
+        """
+        self.limit = limit
+        self.period = period
+
+    @abc.abstractmethod
+    def acquire(self, key: str) -> None:
+        """Count an attempt of a key.
+
+        Args:
+            key (str): The key, e.g. the client IP.
+
+        Raises:
+            RateLimited: If the key has no attempt left.
+        """
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Token buckets in an in-process dict.
+
+    Each key holds `limit` tokens refilled at `limit / period` per second,
+    so bursts up to `limit` go through. A bucket left idle for a period is
+    full again, so it is dropped by the sweep run once per period.
+    """
+
+    def __init__(self, limit: int, period: float) -> None:
+        """See RateLimiter."""
+        super().__init__(limit, period)
+        self._rate = limit / period
+        # Tokens left and time of the last update, by key
+        self._buckets: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + period
+
+    def acquire(self, key: str) -> None:
+        """See RateLimiter.acquire."""
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.limit), now]
+            tokens = min(self.limit,
+                         bucket[0] + (now - bucket[1]) * self._rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                raise RateLimited(math.ceil((1 - tokens) / self._rate))
+            bucket[0] = tokens - 1
+
+    def _sweep(self, now: float) -> None:
+        """Drop the buckets idle for a period, with the lock held."""
+        idle = [key for key, (_, updated) in self._buckets.items()
+                if now - updated >= self.period]
+        for key in idle:
+            del self._buckets[key]
+        self._next_sweep = now + self.period
+
+    def __len__(self) -> int:
+        """Return the number of tracked keys."""
+        return len(self._buckets)
+
+
+class RedisRateLimiter(RateLimiter):
+    """Sliding windows on a Redis-protocol server.
+
+    Each key counts its allowed attempts in one counter per window of
+    `period` seconds, expired by the server. The count of the previous
+    window is weighted by its share of the sliding window.
+    """
+
+    def __init__(self, client: Any, limit: int, period: float,
+                 prefix: str = "ratelimit:") -> None:
+        """Initialize the limiter on a client.
+
+        Args:
+            client (Any): A redis.Redis compatible client.
+            limit (int): The attempts allowed per period.
+            period (float): The period in seconds.
+            prefix (str): Prefix of the keys of the limiter.
+        """
+        super().__init__(limit, period)
+        self._client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, *args: Any,
+                 **kwargs: Any) -> "RedisRateLimiter":
+        """Create a limiter on a redis.Redis client for the given URL.
+
+        Args:
+            url (str): The server URL, e.g. "redis://localhost:6379/0".
+            *args: Arguments of RedisRateLimiter after the client.
+            **kwargs: Keyword arguments of RedisRateLimiter.
+        """
+        import redis
+
+        return cls(redis.Redis.from_url(url), *args, **kwargs)
+
+    def acquire(self, key: str) -> None:
+        """See RateLimiter.acquire."""
+        now = time.time()
+        window, elapsed = divmod(now, self.period)
+        current = "{}{}:{}".format(self.prefix, key, int(window))
+        previous = "{}{}:{}".format(self.prefix, key, int(window) - 1)
+        pipe = self._client.pipeline()
+        pipe.incr(current)
+        pipe.expire(current, math.ceil(self.period * 2))
+        pipe.get(previous)
+        count, _, before = pipe.execute()
+        before = int(before or 0)
+        if before * (1 - elapsed / self.period) + count > self.limit:
+            # A refused attempt is not counted, like in MemoryRateLimiter
+            self._client.decr(current)
+            if count > self.limit:
+                # Full on its own, wait for the next window
+                retry_after = self.period - elapsed
+            else:
+                # Wait for the previous window to fade enough
+                retry_after = self.period * (
+                    before - self.limit + count) / before - elapsed
+            raise RateLimited(max(1, math.ceil(retry_after)))
+
+
+def parse_rate(rate: str) -> Optional[Tuple[int, float]]:
+    """Parse a rate such as "10/60", 10 attempts per 60 seconds.
+
+    Args:
+        rate (str): The rate, or "off" for no limit.
+
+    Returns:
+        Optional[Tuple[int, float]]: The limit and the period, None for no
+        limit.
+    """
+    if rate.strip().lower() in ("off", "0", ""):
+        return None
+    limit, _, period = rate.partition("/")
+    return int(limit), float(period or 60)
+
+
+def rate_limiter_from_env(name: str, default: str) -> Optional[RateLimiter]:
+    """Create the limiter configured by an environment variable.
+
+    The variable holds a rate as read by parse_rate, and RATE_LIMIT_STORE
+    selects the backend: "memory" (the default) or "redis", connecting to
+    REDIS_URL.
+
+    Args:
+        name (str): The variable, e.g. "RATE_LIMIT_IP".
+        default (str): The rate if the variable is not set.
+
+    Returns:
+        Optional[RateLimiter]: The limiter, None if the rate is "off".
+    """
+    rate = parse_rate(os.getenv(name, default))
+    if rate is None:
+        return None
+    backend = os.getenv("RATE_LIMIT_STORE", "memory")
+    if backend == "memory":
+        return MemoryRateLimiter(*rate)
+    if backend == "redis":
+        return RedisRateLimiter.from_url(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"), *rate,
+            prefix="ratelimit:{}:".format(name.lower()))
+    raise ValueError("Unknown rate limit store {}".format(backend))
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Session store module
+
+Backends keeping the sessions of the users:
+1. SQLSessionStore: the users.session_id column, one session per user
+2. MemorySessionStore: an in-process dict with expiry
+3. RedisSessionStore: any client speaking the Redis protocol, e.g. a
+   redis.Redis or a fakeredis.FakeRedis
+4. SignedSessionStore: stateless HMAC-signed tokens, no shared state
+"""
+import abc
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Set, Tuple
+
+from cache import TTLCache
+from db import DB, Principal
+from user import User
+
+
+class SessionStore(abc.ABC):
+    """Interface of the session backends."""
+
+    @abc.abstractmethod
+    def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """Create a session for a user.
+
+        Args:
+            user (User): The user logging in.
+            ttl (Optional[float]): Seconds the session lasts, the store's
+                default if None.
+
+        Returns:
+            str: The session ID.
+        """
+
+    def get(self, session_id: str) -> Optional[User]:
+        """Find the user of a live session.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            Optional[User]: The user, at least its id and email, None if
+            the session is unknown or expired.
+        """
+        principal = self.get_principal(session_id)
+        if principal is None:
+            return None
+        return User(id=principal.id, email=principal.email)
+
+    @abc.abstractmethod
+    def get_principal(self, session_id: str) -> Optional[Principal]:
+        """Find the id and email of the user of a live session, without
+        building a User.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            Optional[Principal]: The user's id and email, None if the
+            session is unknown or expired.
+        """
+
+    @abc.abstractmethod
+    def destroy(self, user_id: int) -> None:
+        """Destroy every session of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+        """
+
+
+class SQLSessionStore(SessionStore):
+    """Sessions in the users.session_id column, looked up through the
+    session cache of DB. A user has a single session, which lasts until it
+    is destroyed: the column has no expiry, so `ttl` is ignored.
+    """
+
+    def __init__(self, db: DB) -> None:
+        """Initialize the store on a database."""
+        self._db = db
+
+    def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """See SessionStore.create."""
+        session_id = str(uuid.uuid4())
+        self._db.update_user(user.id, session_id=session_id)
+        return session_id
+
+    def get(self, session_id: str) -> Optional[User]:
+        """See SessionStore.get."""
+        return self._db.find_user_by_session_id(session_id)
+
+    def get_principal(self, session_id: str) -> Optional[Principal]:
+        """See SessionStore.get_principal."""
+        return self._db.get_session_principal(session_id)
+
+    def destroy(self, user_id: int) -> None:
+        """See SessionStore.destroy."""
+        self._db.update_user(user_id, session_id=None)
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in an in-process dict, expired lazily on lookup and swept
+    when sessions are created.
+    """
+
+    def __init__(self, ttl: float = 86400) -> None:
+        """Initialize an empty store.
+
+        Args:
+            ttl (float): Default seconds a session lasts.
+        """
+        self.ttl = ttl
+        self._sessions: Dict[str, Tuple[float, int, str]] = {}
+        self._by_user: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + ttl
+
+    def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """See SessionStore.create."""
+        session_id = str(uuid.uuid4())
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._sweep()
+            self._sessions[session_id] = (expires, user.id, user.email)
+            self._by_user.setdefault(user.id, set()).add(session_id)
+        return session_id
+
+    def get_principal(self, session_id: str) -> Optional[Principal]:
+        """See SessionStore.get_principal."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if session[0] <= time.monotonic():
+                self._drop(session_id)
+                return None
+        return Principal(session[1], session[2])
+
+    def destroy(self, user_id: int) -> None:
+        """See SessionStore.destroy."""
+        with self._lock:
+            for session_id in list(self._by_user.get(user_id, ())):
+                self._drop(session_id)
+
+    def _drop(self, session_id: str) -> None:
+        """Remove a session, the lock being held."""
+        _, user_id, _ = self._sessions.pop(session_id)
+        sessions = self._by_user[user_id]
+        sessions.discard(session_id)
+        if not sessions:
+            del self._by_user[user_id]
+
+    def _sweep(self) -> None:
+        """Remove the expired sessions at most once per `ttl`, the lock
+        being held."""
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.ttl
+        for session_id, session in list(self._sessions.items()):
+            if session[0] <= now:
+                self._drop(session_id)
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions in a Redis-protocol server, expired by the server.
+
+    Each session is a key holding the user's id and email, and each user
+    has a set of its session IDs so that they can be destroyed together.
+    """
+
+    def __init__(self, client: Any, ttl: float = 86400,
+                 prefix: str = "session:") -> None:
+        """Initialize the store on a client.
+
+        Args:
+            client (Any): A redis.Redis compatible client.
+            ttl (float): Default seconds a session lasts.
+            prefix (str): Prefix of the keys of the store.
+        """
+        self._client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: Any) -> "RedisSessionStore":
+        """Create a store on a redis.Redis client for the given URL.
+
+        Args:
+            url (str): The server URL, e.g. "redis://localhost:6379/0".
+            **kwargs: Keyword arguments of RedisSessionStore.
+        """
+        import redis
+
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _user_key(self, user_id: int) -> str:
+        """Return the key of the set of sessions of a user."""
+        return "{}user:{}".format(self.prefix, user_id)
+
+    def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """See SessionStore.create."""
+        session_id = str(uuid.uuid4())
+        ttl = max(1, int(self.ttl if ttl is None else ttl))
+        user_key = self._user_key(user.id)
+        pipe = self._client.pipeline()
+        pipe.set(self.prefix + session_id,
+                 json.dumps({"id": user.id, "email": user.email}), ex=ttl)
+        pipe.sadd(user_key, session_id)
+        # The set outlives the sessions it lists: its expiry is set if it
+        # has none and otherwise only ever pushed back (Redis 7 or newer)
+        pipe.expire(user_key, ttl, nx=True)
+        pipe.expire(user_key, ttl, gt=True)
+        pipe.execute()
+        return session_id
+
+    def get_principal(self, session_id: str) -> Optional[Principal]:
+        """See SessionStore.get_principal."""
+        value = self._client.get(self.prefix + session_id)
+        if value is None:
+            return None
+        return Principal(**json.loads(value))
+
+    def destroy(self, user_id: int) -> None:
+        """See SessionStore.destroy."""
+        user_key = self._user_key(user_id)
+        session_ids = self._client.smembers(user_key)
+        keys = [self.prefix + (session_id.decode()
+                               if isinstance(session_id, bytes)
+                               else session_id)
+                for session_id in session_ids]
+        self._client.delete(user_key, *keys)
+
+
+class SignedSessionStore(SessionStore):
+    """Stateless sessions: the session ID is an HMAC-signed token carrying
+    the user's id and email, its issue and expiry times and the user's
+    session version.
+
+    A lookup only verifies the signature and the expiry, and compares the
+    version with the user's current one, read from the database at most
+    once per `version_ttl` seconds per user. Destroying the sessions of a
+    user bumps its version, which revokes every token issued before; other
+    processes notice it within `version_ttl`.
+    """
+
+    def __init__(self, db: DB, secret: bytes, ttl: float = 86400,
+                 version_ttl: float = 5, maxsize: int = 10000) -> None:
+        """Initialize the store.
+
+        Args:
+            db (DB): The database holding the session versions.
+            secret (bytes): The signing key, shared by every process.
+            ttl (float): Default seconds a session lasts.
+            version_ttl (float): Seconds a session version is cached.
+            maxsize (int): The maximum number of cached versions.
+        """
+        self._db = db
+        self._secret = secret
+        self.ttl = ttl
+        self._versions = TTLCache(maxsize=maxsize, ttl=version_ttl,
+                                  negative_ttl=version_ttl)
+
+    def _sign(self, payload: bytes) -> bytes:
+        """Return the urlsafe base64 HMAC-SHA256 of a payload."""
+        digest = hmac.new(self._secret, payload, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=")
+
+    def _version(self, user_id: int) -> Optional[int]:
+        """Return the current session version of a user."""
+        found, version = self._versions.get(user_id)
+        if not found:
+            # A destroy during the read drops the version read before it
+            generation = self._versions.generation()
+            version = self._db.get_session_version(user_id)
+            self._versions.set(user_id, version, generation=generation)
+        return version
+
+    def create(self, user: User, ttl: Optional[float] = None) -> str:
+        """See SessionStore.create."""
+        issued = int(time.time())
+        claims = {
+            "id": user.id,
+            "email": user.email,
+            "iat": issued,
+            "exp": issued + int(self.ttl if ttl is None else ttl),
+            "ver": user.session_version or 0,
+        }
+        payload = base64.urlsafe_b64encode(
+            json.dumps(claims, separators=(",", ":")).encode()).rstrip(b"=")
+        return (payload + b"." + self._sign(payload)).decode()
+
+    def get_principal(self, session_id: str) -> Optional[Principal]:
+        """See SessionStore.get_principal."""
+        payload, _, signature = session_id.encode().partition(b".")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(
+            payload + b"=" * (-len(payload) % 4)))
+        if claims["exp"] <= time.time() or \
+                claims["ver"] != self._version(claims["id"]):
+            return None
+        return Principal(claims["id"], claims["email"])
+
+    def destroy(self, user_id: int) -> None:
+        """See SessionStore.destroy."""
+        self._db.bump_session_version(user_id)
+        self._versions.delete(user_id)
+
+
+def session_store_from_env(db: DB) -> SessionStore:
+    """Create the store selected by the SESSION_STORE environment variable:
+    "sql" (the default), "memory", "redis", connecting to REDIS_URL, or
+    "signed", signing with SESSION_SECRET. SESSION_TTL sets the default
+    session lifetime in seconds.
+
+    Args:
+        db (DB): The database of the SQL store.
+
+    Returns:
+        SessionStore: The session store.
+    """
+    backend = os.getenv("SESSION_STORE", "sql")
+    ttl = float(os.getenv("SESSION_TTL", "86400"))
+    if backend == "sql":
+        return SQLSessionStore(db)
+    if backend == "memory":
+        return MemorySessionStore(ttl)
+    if backend == "redis":
+        return RedisSessionStore.from_url(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"), ttl=ttl)
+    if backend == "signed":
+        secret = os.getenv("SESSION_SECRET")
+        if not secret:
+            raise ValueError("SESSION_SECRET is required by signed sessions")
+        return SignedSessionStore(db, secret.encode(), ttl)
+    raise ValueError("Unknown session store {}".format(backend))
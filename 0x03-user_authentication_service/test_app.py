@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Unit tests for app.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import app as app_module
+from db import DB
+from rate_limit import MemoryRateLimiter
+
+
+class AppTestCase(unittest.TestCase):
+    """Base of the tests of the app, with a registered user."""
+
+    def setUp(self):
+        """Creates the app on a fresh file-backed SQLite database, with the
+        session cache off so that every request reads the database."""
+        directory = tempfile.mkdtemp(prefix="test-app-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        patches = (
+            mock.patch.dict(os.environ, {
+                "DB_URL": "sqlite:///{}".format(
+                    os.path.join(directory, "test.db")),
+                "BCRYPT_ROUNDS": "4",
+                "SESSION_STORE": "sql",
+                "SESSION_CACHE_TTL": "0",
+                "SESSION_CACHE_NEGATIVE_TTL": "0",
+            }),
+            mock.patch.object(app_module, "_auth", None),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        DB()
+        self.app = app_module.create_app()
+        client = self.app.test_client()
+        client.post("/users", data={"email": "bob@dylan.com",
+                                    "password": "secret"})
+        response = client.post("/sessions", data={"email": "bob@dylan.com",
+                                                  "password": "secret"})
+        self.assertEqual(response.status_code, 200)
+        self.session_id = client.get_cookie("session_id").value
+
+
+class TestConcurrentProfile(AppTestCase):
+    """Tests of concurrent requests on thread-scoped database sessions."""
+
+    THREADS = 16
+    REQUESTS = 25
+
+    def test_profile_threads(self):
+        """Every response of N threads is a 200 and every connection is
+        back in the pool once they are done."""
+        results = []
+        lock = threading.Lock()
+
+        def requests():
+            """Sends REQUESTS profile requests from a thread."""
+            client = self.app.test_client()
+            client.set_cookie("session_id", self.session_id)
+            for _ in range(self.REQUESTS):
+                response = client.get("/profile")
+                with lock:
+                    results.append((response.status_code,
+                                    response.get_json()))
+
+        threads = [threading.Thread(target=requests)
+                   for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), self.THREADS * self.REQUESTS)
+        self.assertEqual(set(status for status, _ in results), {200})
+        self.assertTrue(all(body == {"email": "bob@dylan.com"}
+                            for _, body in results))
+        # Each request released its session, and its connection with it
+        pool = app_module.get_auth()._db._engine.pool
+        self.assertEqual(pool.checkedout(), 0)
+
+
+class TestRateLimit(AppTestCase):
+    """Tests of the rate limits of the login attempts."""
+
+    def setUp(self):
+        """Allows two attempts per minute and client IP."""
+        super().setUp()
+        patches = (
+            mock.patch.object(app_module, "LIMITS_BY_IP",
+                              MemoryRateLimiter(2, 60)),
+            mock.patch.object(app_module, "LIMITS_BY_EMAIL", None),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_too_many_logins(self):
+        """The attempt over the limit gets a 429 with a Retry-After."""
+        client = self.app.test_client()
+        data = {"email": "bob@dylan.com", "password": "wrong"}
+        self.assertEqual(client.post("/sessions", data=data).status_code,
+                         401)
+        data["password"] = "secret"
+        self.assertEqual(client.post("/sessions", data=data).status_code,
+                         200)
+        response = client.post("/sessions", data=data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.get_json(),
+                         {"message": "too many requests"})
+        # One attempt comes back every 30 seconds
+        self.assertEqual(response.headers["Retry-After"], "30")
+
+
+if __name__ == "__main__":
+    unittest.main()
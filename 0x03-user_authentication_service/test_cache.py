@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Unit tests for cache.
+"""
+import unittest
+from unittest import mock
+
+from cache import TTLCache
+
+
+class TestGeneration(unittest.TestCase):
+    """Tests that a value read before an invalidation is never stored."""
+
+    def setUp(self):
+        """Creates a cache."""
+        self.cache = TTLCache(maxsize=10, ttl=60, negative_ttl=5)
+
+    def test_set_older_than_delete(self):
+        """A fill started before a delete of its key is dropped."""
+        generation = self.cache.generation()
+        self.cache.delete("session")
+        self.cache.set("session", "stale", generation=generation)
+        self.assertEqual(self.cache.get("session"), (False, None))
+        # A fill started after the delete is stored
+        self.cache.set("session", "fresh",
+                       generation=self.cache.generation())
+        self.assertEqual(self.cache.get("session"), (True, "fresh"))
+
+    def test_set_older_than_delete_tag(self):
+        """A fill started before a delete of its tag is dropped."""
+        generation = self.cache.generation()
+        self.cache.delete_tag(1)
+        self.cache.set("session", "stale", tag=1, generation=generation)
+        self.assertEqual(self.cache.get("session"), (False, None))
+        self.cache.set("other", "kept", tag=2, generation=generation)
+        self.assertEqual(self.cache.get("other"), (True, "kept"))
+
+    def test_unrelated_delete(self):
+        """A delete of another key or tag does not drop a fill."""
+        generation = self.cache.generation()
+        self.cache.delete("other")
+        self.cache.delete_tag(2)
+        self.cache.set("session", "value", tag=1, generation=generation)
+        self.assertEqual(self.cache.get("session"), (True, "value"))
+
+    def test_set_older_than_forgotten_deletes(self):
+        """Once the deletes are forgotten, to bound their memory, or the
+        cache is cleared, every fill started before is dropped."""
+        generation = self.cache.generation()
+        for key in range(self.cache.maxsize + 1):
+            self.cache.delete(key)
+        self.cache.set("session", "stale", generation=generation)
+        self.assertEqual(self.cache.get("session"), (False, None))
+        generation = self.cache.generation()
+        self.cache.clear()
+        self.cache.set("session", "stale", generation=generation)
+        self.assertEqual(self.cache.get("session"), (False, None))
+
+
+class TestExpiry(unittest.TestCase):
+    """Tests of the expiry and the eviction of the entries."""
+
+    def setUp(self):
+        """Creates a cache on a clock set by the test."""
+        self.now = 1000.0
+        patch = mock.patch("cache.time.monotonic", lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.cache = TTLCache(maxsize=2, ttl=60, negative_ttl=5)
+
+    def test_negative_entry_expires_first(self):
+        """A None entry expires after negative_ttl, others after ttl."""
+        self.cache.set("missing", None)
+        self.cache.set("found", "value")
+        self.now += 4
+        self.assertEqual(self.cache.get("missing"), (True, None))
+        self.now += 2
+        self.assertEqual(self.cache.get("missing"), (False, None))
+        self.assertEqual(self.cache.get("found"), (True, "value"))
+        self.now += 60
+        self.assertEqual(self.cache.get("found"), (False, None))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_no_negative_caching(self):
+        """A negative_ttl of 0 caches no None entry."""
+        cache = TTLCache(negative_ttl=0)
+        cache.set("missing", None)
+        self.assertEqual(cache.get("missing"), (False, None))
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted when full."""
+        self.cache.set("a", 1, tag=1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("b"), (False, None))
+        self.assertEqual(self.cache.get("a"), (True, 1))
+        self.cache.delete_tag(1)
+        self.assertEqual(self.cache.get("a"), (False, None))
+        self.assertEqual(self.cache.get("c"), (True, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
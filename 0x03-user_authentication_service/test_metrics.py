@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Unit tests for metrics.
+"""
+import gc
+import threading
+import unittest
+
+import bcrypt
+from flask import Flask, abort
+
+import hashing
+import metrics
+from metrics import Callback, Counter, Histogram, Metric
+
+
+def sample(text: str, name: str) -> float:
+    """Returns the value of a sample of the text format, 0 if absent."""
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0
+
+
+class TestRender(unittest.TestCase):
+    """Tests of the text format."""
+
+    def test_abstract(self):
+        """A metric type must render itself."""
+        with self.assertRaises(TypeError):
+            Metric("m", "M.")
+
+    def test_counter(self):
+        """A counter renders a sample per label values, escaped."""
+        counter = Counter("jobs_total", "Jobs.", ("queue",))
+        counter.inc("a")
+        counter.inc("a", amount=2)
+        counter.inc('b"\n')
+        self.assertEqual(counter.render(), [
+            "# HELP jobs_total Jobs.",
+            "# TYPE jobs_total counter",
+            'jobs_total{queue="a"} 3',
+            'jobs_total{queue="b\\"\\n"} 1',
+        ])
+
+    def test_histogram(self):
+        """A histogram renders cumulative buckets, the sum and the count."""
+        histogram = Histogram("latency_seconds", "Latency.", ("route",),
+                              buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.observe(value, "/")
+        self.assertEqual(histogram.render(), [
+            "# HELP latency_seconds Latency.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{route="/",le="0.1"} 1',
+            'latency_seconds_bucket{route="/",le="1"} 3',
+            'latency_seconds_bucket{route="/",le="+Inf"} 4',
+            'latency_seconds_sum{route="/"} 4.05',
+            'latency_seconds_count{route="/"} 4',
+        ])
+
+    def test_callback(self):
+        """A callback renders the value read when scraped."""
+        self.assertEqual(Callback("depth", "Depth.", lambda: 2).render()[2:],
+                         ["depth 2"])
+
+
+class TestShards(unittest.TestCase):
+    """Tests of the per-thread shards."""
+
+    def test_dead_thread_shards_folded(self):
+        """The shards of finished threads are folded into the base, with
+        their counts."""
+        counter = Counter("threads_total", "Threads.")
+
+        def record():
+            """Records from a short-lived thread."""
+            counter.inc()
+
+        for _ in range(200):
+            thread = threading.Thread(target=record)
+            thread.start()
+            thread.join()
+        counter.inc()
+        gc.collect()
+        self.assertEqual(counter.render()[-1], "threads_total 201")
+        # Only the shard of this thread is left
+        self.assertEqual(len(counter._shards), 1)
+
+
+class TestInstrumentApp(unittest.TestCase):
+    """Tests of the request metrics of a Flask app."""
+
+    def setUp(self):
+        """Creates an instrumented app with a route per outcome."""
+        self.app = Flask(__name__)
+
+        @self.app.route("/ok/<name>")
+        def ok(name):
+            """Answers."""
+            return name
+
+        @self.app.route("/missing")
+        def missing():
+            """Aborts."""
+            abort(404)
+
+        @self.app.route("/boom")
+        def boom():
+            """Fails."""
+            raise RuntimeError("boom")
+
+        metrics.instrument_app(self.app)
+        self.client = self.app.test_client()
+
+    def count(self, method, route, status):
+        """Returns the number of requests recorded so far."""
+        return sample(
+            self.client.get("/metrics").get_data(as_text=True),
+            'http_request_duration_seconds_count{{method="{}",route="{}",'
+            'status="{}"}}'.format(method, route, status))
+
+    def test_one_request(self):
+        """A request is recorded once, under its rule and status."""
+        for path, route, status in (("/ok/bob", "/ok/<name>", 200),
+                                    ("/missing", "/missing", 404),
+                                    ("/boom", "/boom", 500)):
+            before = self.count("GET", route, status)
+            self.assertEqual(self.client.get(path).status_code, status)
+            self.assertEqual(self.count("GET", route, status), before + 1)
+
+
+class TestInstrumentHasher(unittest.TestCase):
+    """Tests of the hashing service metrics."""
+
+    def test_instrument_twice(self):
+        """A service instrumented twice records each operation once."""
+        service = hashing.HashingService(workers=1, max_pending=1)
+        # Exports the queue of the shared service again afterwards
+        self.addCleanup(metrics.instrument_hasher)
+        metrics.instrument_hasher(service)
+        metrics.instrument_hasher(service)
+        name = 'password_hash_duration_seconds_count{operation="hashpw"}'
+        before = sample(metrics.REGISTRY.render(), name)
+        service.run(bcrypt.hashpw, b"secret", bcrypt.gensalt(4))
+        # The listeners run on the worker, done once it is stopped
+        service.shutdown()
+        self.assertEqual(sample(metrics.REGISTRY.render(), name),
+                         before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Unit tests for rate_limit.
+"""
+import unittest
+from unittest import mock
+
+import fakeredis
+
+from rate_limit import (
+    MemoryRateLimiter, RateLimited, RateLimiter, RedisRateLimiter, parse_rate,
+)
+
+
+class Clock:
+    """Time set by the test, patched over time.monotonic and time.time."""
+
+    def __init__(self, now: float) -> None:
+        """Starts at a given time."""
+        self.now = now
+
+    def __call__(self) -> float:
+        """Returns the current time."""
+        return self.now
+
+
+class LimiterTestCase(unittest.TestCase):
+    """Base of the tests, on a clock set by the test."""
+
+    def setUp(self):
+        """Starts the clock at the beginning of a window."""
+        self.clock = Clock(6000.0)
+        for name in ("rate_limit.time.monotonic", "rate_limit.time.time"):
+            patch = mock.patch(name, self.clock)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def assertLimited(self, limiter, key, retry_after):
+        """Asserts that an attempt is refused with a given Retry-After."""
+        with self.assertRaises(RateLimited) as context:
+            limiter.acquire(key)
+        self.assertEqual(context.exception.retry_after, retry_after)
+
+
+class TestMemoryRateLimiter(LimiterTestCase):
+    """Tests of the token buckets."""
+
+    def test_abstract(self):
+        """The interface cannot be instantiated."""
+        with self.assertRaises(TypeError):
+            RateLimiter(1, 1)
+
+    def test_limit_and_refill(self):
+        """A burst of `limit` attempts goes through, then an attempt comes
+        back every period / limit seconds."""
+        limiter = MemoryRateLimiter(3, 60)
+        for _ in range(3):
+            limiter.acquire("10.0.0.1")
+        self.assertLimited(limiter, "10.0.0.1", 20)
+        limiter.acquire("10.0.0.2")
+        self.clock.now += 15
+        self.assertLimited(limiter, "10.0.0.1", 5)
+        self.clock.now += 5
+        limiter.acquire("10.0.0.1")
+        # A full period refills the whole bucket
+        self.clock.now += 60
+        for _ in range(3):
+            limiter.acquire("10.0.0.1")
+
+    def test_idle_keys_evicted(self):
+        """The keys idle for a period are dropped, so the state stays
+        bounded by the keys seen in the last two periods."""
+        limiter = MemoryRateLimiter(3, 60)
+        for i in range(1000):
+            limiter.acquire("10.0.{}.{}".format(i // 256, i % 256))
+        self.assertEqual(len(limiter), 1000)
+        self.clock.now += 60
+        limiter.acquire("10.1.0.0")
+        self.assertEqual(len(limiter), 1)
+
+
+class TestRedisRateLimiter(LimiterTestCase):
+    """Tests of the sliding windows on a fakeredis server."""
+
+    def setUp(self):
+        """Creates a limiter of 3 attempts a minute."""
+        super().setUp()
+        self.client = fakeredis.FakeRedis()
+        self.limiter = RedisRateLimiter(self.client, 3, 60)
+
+    def test_limit_and_refill(self):
+        """`limit` attempts go through in a window, then the attempts come
+        back as the previous window slides out."""
+        for _ in range(3):
+            self.limiter.acquire("10.0.0.1")
+        self.assertLimited(self.limiter, "10.0.0.1", 60)
+        self.limiter.acquire("10.0.0.2")
+        # Halfway through the next window, half of the previous one counts
+        self.clock.now += 90
+        self.limiter.acquire("10.0.0.1")
+        self.assertLimited(self.limiter, "10.0.0.1", 10)
+        self.clock.now += 10
+        self.limiter.acquire("10.0.0.1")
+
+    def test_keys_expire(self):
+        """The counters of a key expire after two periods."""
+        self.limiter.acquire("10.0.0.1")
+        self.assertEqual(self.client.ttl("ratelimit:10.0.0.1:100"), 120)
+
+
+class TestParseRate(unittest.TestCase):
+    """Tests of the rate syntax."""
+
+    def test_parse_rate(self):
+        """A rate is attempts/seconds, per minute by default, or off."""
+        self.assertEqual(parse_rate("10/30"), (10, 30.0))
+        self.assertEqual(parse_rate("10"), (10, 60.0))
+        self.assertIsNone(parse_rate("off"))
+        self.assertIsNone(parse_rate("0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
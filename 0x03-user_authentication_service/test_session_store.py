@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Unit tests for session_store.
+"""
+import unittest
+
+import fakeredis
+
+from db import Principal
+from session_store import RedisSessionStore, SessionStore, SignedSessionStore
+from user import User
+
+
+class TestSessionStore(unittest.TestCase):
+    """Tests of the SessionStore interface."""
+
+    def test_abstract(self):
+        """The interface cannot be instantiated."""
+        with self.assertRaises(TypeError):
+            SessionStore()
+
+    def test_get_from_get_principal(self):
+        """A store implementing get_principal gets get for free."""
+        class Store(SessionStore):
+            """Store of a single session."""
+
+            def create(self, user, ttl=None):
+                """Not used."""
+
+            def get_principal(self, session_id):
+                """The session "s" is user 1's."""
+                return Principal(1, "bob@dylan.com") \
+                    if session_id == "s" else None
+
+            def destroy(self, user_id):
+                """Not used."""
+
+        self.assertEqual(Store().get("s").email, "bob@dylan.com")
+        self.assertIsNone(Store().get("t"))
+
+
+class TestRedisSessionStore(unittest.TestCase):
+    """Tests of RedisSessionStore on a fakeredis server."""
+
+    def setUp(self):
+        """Creates a store with a default session lifetime of 10 s."""
+        self.client = fakeredis.FakeRedis()
+        self.store = RedisSessionStore(self.client, ttl=10)
+        self.user = User(id=1, email="bob@dylan.com")
+
+    def test_create_get_destroy(self):
+        """A session finds its user until the user's sessions are
+        destroyed."""
+        session_id = self.store.create(self.user)
+        principal = self.store.get_principal(session_id)
+        self.assertEqual((principal.id, principal.email),
+                         (1, "bob@dylan.com"))
+        self.assertEqual(self.store.get(session_id).email, "bob@dylan.com")
+        self.store.destroy(1)
+        self.assertIsNone(self.store.get_principal(session_id))
+        self.assertIsNone(self.store.get("unknown"))
+
+    def test_session_ttl(self):
+        """The session key expires after its own lifetime."""
+        session_id = self.store.create(self.user, ttl=1000)
+        self.assertEqual(self.client.ttl("session:" + session_id), 1000)
+        session_id = self.store.create(self.user)
+        self.assertEqual(self.client.ttl("session:" + session_id), 10)
+
+    def test_user_set_ttl_never_shortened(self):
+        """A shorter session does not shorten the expiry of the set of
+        the user's sessions, which must outlive the longest one."""
+        long_session = self.store.create(self.user, ttl=1000)
+        short_session = self.store.create(self.user)
+        self.assertEqual(self.client.ttl("session:user:1"), 1000)
+        self.store.create(self.user, ttl=2000)
+        self.assertEqual(self.client.ttl("session:user:1"), 2000)
+        self.store.destroy(1)
+        self.assertIsNone(self.store.get_principal(long_session))
+        self.assertIsNone(self.store.get_principal(short_session))
+
+
+class VersionDB:
+    """Session versions of a DB, running a hook in the middle of a read,
+    after the version is read and before it is returned."""
+
+    def __init__(self):
+        """Starts every user at version 0."""
+        self.versions = {}
+        self.during_read = None
+
+    def get_session_version(self, user_id):
+        """Returns the version read before the hook ran."""
+        version = self.versions.get(user_id, 0)
+        if self.during_read is not None:
+            hook, self.during_read = self.during_read, None
+            hook()
+        return version
+
+    def bump_session_version(self, user_id):
+        """Revokes the sessions of a user."""
+        self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+
+class TestSignedSessionStore(unittest.TestCase):
+    """Tests of SignedSessionStore on an in-memory version table."""
+
+    def setUp(self):
+        """Creates a store caching the versions for a minute."""
+        self.db = VersionDB()
+        self.store = SignedSessionStore(self.db, b"secret", version_ttl=60)
+        self.user = User(id=1, email="bob@dylan.com", session_version=0)
+
+    def test_destroy_revokes(self):
+        """A token is valid until the sessions of its user are destroyed."""
+        session_id = self.store.create(self.user)
+        self.assertEqual(self.store.get(session_id).email, "bob@dylan.com")
+        self.store.destroy(1)
+        self.assertIsNone(self.store.get_principal(session_id))
+        self.assertIsNone(self.store.get_principal(session_id + "x"))
+
+    def test_destroy_during_cache_fill(self):
+        """A version read before a destroy is not cached after it, so the
+        revoked token is rejected on the next lookup."""
+        session_id = self.store.create(self.user)
+        self.db.during_read = lambda: self.store.destroy(1)
+        # The lookup racing with the destroy still saw the old version
+        self.assertIsNotNone(self.store.get_principal(session_id))
+        self.assertIsNone(self.store.get_principal(session_id))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""Tokens module
+
+Reset tokens are handed to the user once and only their digest is stored,
+so a leaked reset_tokens table cannot be used to reset passwords.
+"""
+import hashlib
+
+
+def hash_token(token: str) -> str:
+    """Return the digest of a reset token under which it is stored.
+
+    Args:
+        token (str): The reset token.
+
+    Returns:
+        str: The hex SHA-256 digest of the token.
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
@@ -2,7 +2,7 @@
 """ User Module """
 
 
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import create_engine, Column, ForeignKey, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -16,24 +16,49 @@ class User(Base):
         __tablename__ (str): The name of the table in the database where
             user records are stored.
         id (int): The unique identifier of the user.
-        email (str): The email address of the user.
+        email (str): The email address of the user, unique and indexed.
         hashed_password (str): The hashed password of the user.
         session_id (str): The session ID of the user, used to maintain
-            user sessions.
-        reset_token (str): The reset token of the user, used for password
-            resets.
+            user sessions, unique and indexed.
+        reset_token (str): Legacy reset token of the user, superseded by
+            the reset_tokens table and no longer written.
+        session_version (int): Version of the signed session tokens of the
+            user, bumped to revoke them.
     """
 
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, unique=True, index=True)
     hashed_password = Column(String(250), nullable=False)
-    session_id = Column(String(250), nullable=True)
-    reset_token = Column(String(250), nullable=True)
+    session_id = Column(String(250), nullable=True, unique=True, index=True)
+    reset_token = Column(String(250), nullable=True, unique=True, index=True)
+    session_version = Column(Integer, nullable=False, default=0,
+                             server_default="0")
 
     def __repr__(self):
         """Return a string representation of the User object."""
         return (f"<User(id={self.id}, email='{self.email}', "
                 f"session_id='{self.session_id}', "
                 f"reset_token='{self.reset_token}')>")
+
+
+class ResetToken(Base):
+    """A password reset token, valid until it is used or expires.
+
+    Attributes:
+        __tablename__ (str): The name of the table in the database where
+            reset tokens are stored.
+        token_hash (str): The SHA-256 hex digest of the token, the primary
+            key: the token itself is never stored.
+        user_id (int): The ID of the user resetting its password, indexed.
+        expires_at (int): The Unix time the token expires at, indexed for
+            the sweeper.
+    """
+
+    __tablename__ = 'reset_tokens'
+
+    token_hash = Column(String(64), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
+                     nullable=False, index=True)
+    expires_at = Column(Integer, nullable=False, index=True)